@@ -0,0 +1,65 @@
+#
+# Message delivery microbenchmark
+#    Compares same-loop delivery against the cross-thread threadsafe path
+#    Run from the repository root: PYTHONPATH=. python3 bench/bench_delivery.py
+#
+import asyncio
+import threading
+import time
+import halibot
+
+COUNT = 100000
+
+class Counter(halibot.HalModule):
+
+	def init(self):
+		self.count = 0
+		self.expect = 0
+		self.done = threading.Event()
+
+	def receive(self, msg):
+		self.count += 1
+		if self.count == self.expect:
+			self.done.set()
+
+def threadsafe_queue(obj, msg):
+	return asyncio.run_coroutine_threadsafe(obj._receive(msg), obj.eventloop)
+
+def run(bot, sender, counter, queue):
+	counter.count = 0
+	counter.expect = COUNT
+	counter.done.clear()
+
+	msg = halibot.Message(body='ping', origin=sender.name, target=counter.name)
+
+	def burst():
+		for i in range(COUNT):
+			queue(counter, msg)
+
+	start = time.perf_counter()
+	bot.eventloop.call_soon_threadsafe(burst)
+	counter.done.wait()
+	return COUNT / (time.perf_counter() - start)
+
+def main():
+	bot = halibot.Halibot(use_config=False)
+	bot.start(block=False)
+
+	sender = halibot.HalModule(bot)
+	counter = Counter(bot)
+	bot.add_instance('sender', sender)
+	bot.add_instance('counter', counter)
+
+	try:
+		slow = run(bot, sender, counter, threadsafe_queue)
+		fast = run(bot, sender, counter, lambda o, m: o._queue_msg(m))
+	finally:
+		bot.shutdown()
+
+	print("{:<26} {:>12}".format("path", "msgs/sec"))
+	print("{:<26} {:>12.0f}".format("run_coroutine_threadsafe", slow))
+	print("{:<26} {:>12.0f}".format("same-loop", fast))
+	print("speedup: {:.2f}x".format(fast / slow))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,52 @@
+#
+# Message memory/throughput benchmark
+#    Compares halibot.Message against the previous dict-backed Message
+#    Run from the repository root: PYTHONPATH=. python3 bench/bench_message.py
+#
+import copy
+import logging
+import timeit
+import tracemalloc
+import uuid
+import halibot
+from halibot.jsdict import jsdict
+
+COUNT = 100000
+
+# halibot.Message as it was before __slots__ and lazy fields
+class LegacyMessage():
+
+	def __init__(self, **kwargs):
+		self.log = logging.getLogger(self.__class__.__name__)
+		self.uuid = uuid.uuid4()
+		self.sync = False
+
+		self.body = kwargs.get('body', None)
+		self.type = kwargs.get('type', 'simple')
+		self.author = kwargs.get('author', None)
+		self.identity = kwargs.get('identity', None)
+		self.origin = kwargs.get('origin', None)
+		self.misc = kwargs.get('misc', jsdict())
+		self.target = kwargs.get('target', '')
+
+def memory(cls):
+	tracemalloc.start()
+	msgs = [cls(body='hello', author='someone', origin='agent') for i in range(COUNT)]
+	size, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return size / len(msgs)
+
+def create(cls):
+	return COUNT / timeit.timeit(lambda: cls(body='hello', author='someone', origin='agent'), number=COUNT)
+
+def hop(cls):
+	msg = cls(body='hello', author='someone', origin='agent')
+	return COUNT / timeit.timeit(lambda: copy.copy(msg), number=COUNT)
+
+def main():
+	print("{:<16} {:>14} {:>14} {:>14}".format("class", "bytes/msg", "creates/sec", "copies/sec"))
+	for cls in (LegacyMessage, halibot.Message):
+		print("{:<16} {:>14.0f} {:>14.0f} {:>14.0f}".format(cls.__name__, memory(cls), create(cls), hop(cls)))
+
+if __name__ == "__main__":
+	main()
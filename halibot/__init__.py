@@ -2,7 +2,8 @@ from .halibot import Halibot, Version
 from .halagent import HalAgent
 from .halmodule import HalModule
 from .halfilter import HalFilter
-from .halobject import HalObject, SyncSendSelfException
+from .halobject import HalObject, SyncSendSelfException, SyncSendLoopException
 from .halconfigurer import HalConfigurer
 from .message import Message
 from .commandmodule import CommandModule, AsArgs
+from .profiler import StartupProfile
@@ -2,7 +2,7 @@
 # CommandModule
 #    Subclass of HalModule that does the heavy lifting of commands for you
 #
-from . import HalModule
+from .halmodule import HalModule
 from enum import Enum, auto
 
 class Reason(Enum):
@@ -15,7 +15,7 @@ class Reason(Enum):
 def AsArgs(func):
 	def wrapper(self, string, msg=None):
 		args = string.split(" ")
-		func(self, args, msg=msg)
+		return func(self, args, msg=msg)
 	return wrapper
 
 class CommandModule(HalModule):
@@ -27,8 +27,9 @@ class CommandModule(HalModule):
 	#   string: by default, will be the message not split into arguments
 	#     use the annotation AsArgs above to override this
 	#   msg: not needed in all commands, the message object as received
+	#   Commands may also be coroutines (async def), they are awaited on the loop
 
-	def __init__(self, hal, conf={}):
+	def __init__(self, hal, conf=None):
 		super().__init__(hal, conf=conf)
 
 		self.commands = {}
@@ -36,9 +37,10 @@ class CommandModule(HalModule):
 		self.prefix = self._hal.config.get("command_prefix", "!")
 		self.namespace = None
 
-	# Override only if you know what you are doing!
+	# Override only if you know what you are doing! Agents then dispatch every
+	#  message to this module, instead of only its commands (see DispatchIndex)
 	def receive(self, msg):
-		self._cmd_receive(msg)
+		return self._cmd_receive(msg)
 
 	# Actually does the command handling logic. Separate callable so multi-inheritance
 	#  can work nicely (maybe)
@@ -64,14 +66,16 @@ class CommandModule(HalModule):
 		func = self.commands.get(body[0])
 
 		if func:
-			func(body[1], msg=msg)
+			return func(body[1], msg=msg)
 		else:
 			return Reason.UNKNOWN_COMMAND
 
+	# Returns the awaitable of a coroutine command, if any
 	def _cmd_receive(self, msg):
-		reason = self._cmd_parse(msg)
-		if reason:
-			self.default(msg, reason=reason)
+		ret = self._cmd_parse(msg)
+		if isinstance(ret, Reason):
+			return self.default(msg, reason=ret)
+		return ret
 
 
 	# Override this to provide some functionality if there is no match in the table
@@ -0,0 +1,129 @@
+#
+# DispatchIndex
+#    Decides which modules an agent dispatch goes to. Command traffic is sent
+#    straight to the CommandModules owning the command, and modules declaring
+#    a subscription only get the messages matching it.
+#
+import re
+from .commandmodule import CommandModule
+
+# Compiled body filters of the subscriptions sharing one message type
+class BodyIndex():
+
+	def __init__(self):
+		self.always = [] # No body filter
+		self.prefixes = {} # prefix -> [name, ...]
+		self.lengths = set() # Distinct prefix lengths
+		self.patterns = [] # (compiled regex, name)
+
+	def add(self, name, prefixes, patterns):
+		if prefixes is None and patterns is None:
+			self.always.append(name)
+			return
+
+		for p in prefixes or []:
+			self.prefixes.setdefault(p, []).append(name)
+			self.lengths.add(len(p))
+		for p in patterns or []:
+			self.patterns.append((re.compile(p), name))
+
+	def match(self, body, hits):
+		hits.update(self.always)
+		if not isinstance(body, str):
+			return
+
+		# One dict lookup per distinct prefix length, however many prefixes
+		for n in self.lengths:
+			hits.update(self.prefixes.get(body[:n], []))
+		for regex, name in self.patterns:
+			if regex.search(body):
+				hits.add(name)
+
+# Everything route() looks at, built aside and swapped in as a whole so
+#  agent threads never see a half built index
+class DispatchTables():
+
+	def __init__(self):
+		self.modules = []
+		self.always = [] # Modules without any subscription
+		self.command_modules = []
+		self.commands = {} # (prefix, command or namespace) -> [name, ...]
+		self.any_type = BodyIndex()
+		self.by_type = {} # message type -> BodyIndex
+		self.order = {}
+		self.prefixes = set()
+
+class DispatchIndex():
+
+	def __init__(self, hal):
+		self._hal = hal
+		self._version = 0
+		self.invalidate()
+
+	# Drop the index, it is rebuilt on the next dispatch
+	def invalidate(self):
+		self._version += 1
+		self._tables = None
+
+	# Whether a CommandModule has to see every message rather than just its commands
+	def _wants_raw(self, mod):
+		cls = type(mod)
+		return 'simple' in cls._receivers \
+			or cls.receive is not CommandModule.receive \
+			or cls._cmd_receive is not CommandModule._cmd_receive \
+			or cls._cmd_parse is not CommandModule._cmd_parse \
+			or cls.default is not CommandModule.default
+
+	def build(self):
+		version = self._version
+		t = DispatchTables()
+
+		for name, mod in self._hal.objects.modules.items():
+			t.order[name] = len(t.modules)
+			t.modules.append(name)
+
+			sub = mod.config.get('subscribe', getattr(mod, 'subscribe', None))
+			if sub is not None:
+				types = sub.get('types')
+				for idx in [t.by_type.setdefault(ty, BodyIndex()) for ty in types] if types else [t.any_type]:
+					idx.add(name, sub.get('prefixes'), sub.get('patterns'))
+			elif not isinstance(mod, CommandModule) or self._wants_raw(mod):
+				t.always.append(name)
+			else:
+				t.command_modules.append(name)
+				if mod.namespace:
+					t.commands.setdefault((mod.prefix, mod.namespace), []).append(name)
+				else:
+					for cmd in mod.commands:
+						t.commands.setdefault((mod.prefix, cmd), []).append(name)
+
+		t.prefixes = set(p for p, c in t.commands.keys())
+
+		# Not kept if invalidated while building, the next route builds again
+		if version == self._version:
+			self._tables = t
+		return t
+
+	# Names of the modules msg should be dispatched to, in load order
+	def route(self, msg):
+		t = self._tables
+		if t is None:
+			t = self.build()
+
+		hits = set()
+		t.any_type.match(msg.body, hits)
+		if msg.type in t.by_type:
+			t.by_type[msg.type].match(msg.body, hits)
+
+		if msg.type != 'simple' or not isinstance(msg.body, str):
+			hits.update(t.command_modules)
+		else:
+			# Mirrors CommandModule._cmd_parse, which strips a single prefix character
+			token = msg.body.split(" ", 1)[0]
+			for p in t.prefixes:
+				if token.startswith(p):
+					hits.update(t.commands.get((p, token[1:]), []))
+
+		if not hits:
+			return t.always
+		return sorted(hits.union(t.always), key=t.order.get)
@@ -3,7 +3,9 @@ from .halobject import HalObject
 class HalAgent(HalObject):
 
 	def dispatch(self, msg):
-		out = self.config.get('out', self._hal.objects.modules.keys())
+		out = self.config.get('out')
+		if out is None:
+			out = self._hal.dispatch_index.route(msg)
 		self.send_to(msg, out)
 
 	def connect(self, to):
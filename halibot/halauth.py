@@ -1,6 +1,9 @@
 import json
 import logging
+import os
 import re
+import collections
+import threading
 from halibot.message import Message, MalformedMsgException
 
 def hasPermission(perm, reply=False, argnum=None, key="msg", permissive=True):
@@ -21,74 +24,343 @@ def hasPermission(perm, reply=False, argnum=None, key="msg", permissive=True):
 				raise MalformedMsgException("Missing identity attribute")
 
 			if self._hal.auth.hasPermission(msg.origin, msg.identity, perm, permissive):
-				func(self, *args, **kwargs)
+				return func(self, *args, **kwargs)
 			elif reply:
 				self.reply(msg, body="Permission Denied")
 		return wrapper
 	return real_dec
 
+# Characters that make a permission pattern a regex rather than a literal
+REGEX_META = frozenset(".^$*+?{}[]\\|()")
+
+# Literal patterns are kept as str, everything else is precompiled
+def compile_pattern(pattern):
+	if REGEX_META.isdisjoint(pattern):
+		return pattern
+	return re.compile(pattern)
+
+def match_pattern(pattern, s):
+	# re.match only anchors at the start, so a literal matches as a prefix
+	if pattern.__class__ is str:
+		return s.startswith(pattern)
+	return pattern.match(s) is not None
+
+class Rule():
+
+	def __init__(self, ri, identity, perm):
+		self.key = (ri, identity, perm)
+		self.ri = compile_pattern(ri)
+		self.perm = compile_pattern(perm)
+
+	def matches(self, ri, perm):
+		return match_pattern(self.ri, ri) and match_pattern(self.perm, perm)
+
+# Bounded LRU of (ri, identity, perm) -> decision
+class DecisionCache():
+
+	def __init__(self, maxsize=1024, stats=None):
+		self.maxsize = maxsize
+		self.stats = stats if stats is not None else dict.fromkeys(('hits', 'misses'), 0)
+		self._decisions = collections.OrderedDict()
+
+	def __len__(self):
+		return len(self._decisions)
+
+	def get(self, key):
+		try:
+			decision = self._decisions[key]
+			self._decisions.move_to_end(key)
+		except KeyError:
+			# Missing, or evicted by another thread in between
+			self.stats['misses'] += 1
+			return None
+		self.stats['hits'] += 1
+		return decision
+
+	def put(self, key, decision):
+		self._decisions[key] = decision
+		while len(self._decisions) > self.maxsize:
+			try:
+				self._decisions.popitem(last=False)
+			except KeyError:
+				break
+
+	def clear(self):
+		self._decisions = collections.OrderedDict()
+
+# Compiled rules, bucketed by identity ("*" being its own bucket).
+#  Dicts keyed by the (ri, identity, perm) triple serve as ordered sets.
+#  Carries the decision cache for exactly these rules, so swapping in a new
+#  RuleIndex replaces rules and cached decisions in one assignment.
+class RuleIndex():
+
+	def __init__(self, perms=[], decisions=None):
+		self.rules = {}
+		self.buckets = {}
+		self.decisions = decisions if decisions is not None else DecisionCache()
+		for t in perms:
+			self.add(t)
+
+	def __contains__(self, t):
+		return t in self.rules
+
+	def __len__(self):
+		return len(self.rules)
+
+	@property
+	def perms(self):
+		return list(self.rules)
+
+	# Same rules with an empty decision cache, sharing the compiled Rules
+	def copy(self):
+		new = RuleIndex(decisions=DecisionCache(self.decisions.maxsize, stats=self.decisions.stats))
+		new.rules = dict(self.rules)
+		new.buckets = { k: dict(v) for k, v in self.buckets.items() }
+		return new
+
+	def add(self, t):
+		rule = self.rules[t] = Rule(*t)
+		self.buckets.setdefault(t[1], {})[t] = rule
+
+	def remove(self, t):
+		del self.rules[t]
+		del self.buckets[t[1]][t]
+
+	def match(self, ri, identity, perm):
+		for rule in self.buckets.get(identity, {}).values():
+			if rule.matches(ri, perm):
+				return True
+		if identity != "*":
+			for rule in self.buckets.get("*", {}).values():
+				if rule.matches(ri, perm):
+					return True
+		return False
+
+# Parse a permission file and replay its journal of later changes on top.
+#  Returns the permission triples and the number of journaled changes.
+def read_perms(path):
+	with open(path, "r") as f:
+		temp = json.loads(f.read())
+
+	# Roll back into triple, also technically validates format
+	perms = dict.fromkeys((a,b,c) for a,b,c in temp)
+
+	changes = 0
+	try:
+		with open(path + ".journal", "r") as f:
+			for line in f:
+				try:
+					op, a, b, c = json.loads(line)
+				except ValueError:
+					continue # Torn write, the change never completed
+				if op == "+":
+					perms[(a,b,c)] = None
+				else:
+					perms.pop((a,b,c), None)
+				changes += 1
+	except FileNotFoundError:
+		pass
+
+	return list(perms), changes
+
 class HalAuth():
 
-	def __init__(self):
-		self.perms = []
+	# Journaled changes after which the permission file is rewritten
+	COMPACT_EVERY = 256
+
+	def __init__(self, cache_size=1024):
+		self._rules = RuleIndex(decisions=DecisionCache(cache_size))
 		self.enabled = False
+		self.path = None
 		self.log = logging.getLogger("Auth")
 
+		self._changes = 0 # Changes journaled since the last compaction
+		self._journaling = False # Only once the file was loaded successfully
+
+		self._loop = None # Set while watching the permission file
+		self._stat = None
+		self._reloading = False
+		self._since_reload = [] # (op, triple) changed while a reload is parsing
+
+		# Held while replacing the rules, checks only read self._rules once
+		self._lock = threading.RLock()
+
+	# List of (ri, identity, perm) triples, assigning recompiles the index
+	@property
+	def perms(self):
+		return self._rules.perms
+
+	@perms.setter
+	def perms(self, perms):
+		self._swap(self._compile(perms))
+
+	@property
+	def decisions(self):
+		return self._rules.decisions
+
+	def _compile(self, perms):
+		old = self._rules.decisions
+		return RuleIndex(perms, decisions=DecisionCache(old.maxsize, stats=old.stats))
+
+	# Atomically replace the rules (and their cached decisions)
+	def _swap(self, rules):
+		with self._lock:
+			self._rules = rules
+
 	# Load permission file, and set to enabled
 	def load_perms(self, path):
 		self.path = path
+		self._journaling = False
 
 		try:
-			with open(self.path, "r") as f:
-				temp = json.loads(f.read())
-
-			# Roll back into triple, also technically validates format
-			self.perms = [(a,b,c) for a,b,c in temp]
-
+			self._stat = self._file_stat()
+			self.perms, self._changes = read_perms(self.path)
+			self._journaling = True
 		except Exception as e:
 			self.log.error("Error loading permissions: {}".format(e))
 			self.perms = []
 			# Return if can't find auth?
 
 		self.enabled = True
+		self.compact()
 
-	# Write permissions back to the file that was originally loaded
+	# Write permissions back to the file that was originally loaded, folding
+	#  in (and removing) the journal
 	def write_perms(self):
 		try:
 			temp = [list(l) for l in self.perms]
 
-			with open(self.path, "w") as f:
+			tmp = self.path + ".tmp"
+			with open(tmp, "w") as f:
 				f.write(json.dumps(temp, indent=4))
+			os.replace(tmp, self.path)
+			self._stat = self._file_stat() # Don't reload our own write
+
+			if os.path.exists(self.path + ".journal"):
+				os.remove(self.path + ".journal")
+			self._changes = 0
 		except Exception as e: # pragma: no cover
 				self.log.error("Error storing permissions: {}".format(e))
 
+	def _file_stat(self):
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return None
+		return (st.st_mtime_ns, st.st_size)
+
+	# Poll the permission file every interval seconds on loop, and reload it
+	#  when it changes
+	def watch(self, loop, interval=5):
+		self._loop = loop
+		self._interval = interval
+		loop.call_soon_threadsafe(self._poll)
+
+	def unwatch(self):
+		self._loop = None
+
+	def _poll(self):
+		loop = self._loop
+		if not loop or not self.path:
+			return
+
+		st = self._file_stat()
+		if st and st != self._stat and not self._reloading:
+			self._stat = st
+			with self._lock:
+				self._reloading = True
+				self._since_reload = []
+			# Parse and compile in a worker, checks keep using the current rules
+			fut = loop.run_in_executor(None, lambda: self._compile(read_perms(self.path)[0]))
+			fut.add_done_callback(self._reloaded)
+
+		loop.call_later(self._interval, self._poll)
+
+	def _reloaded(self, fut):
+		with self._lock:
+			self._reloading = False
+			changes, self._since_reload = self._since_reload, []
+			try:
+				rules = fut.result()
+			except Exception as e:
+				self.log.error("Error reloading permissions, keeping the current ones: {}".format(e))
+				return
+
+			# Grants and revokes made while parsing may be missing from it
+			for op, t in changes:
+				if op == "+" and t not in rules:
+					rules.add(t)
+				elif op == "-" and t in rules:
+					rules.remove(t)
+			self._swap(rules)
+		self.log.info("Reloaded permissions from '{}'".format(self.path))
+
+	# Rewrite the permission file if any changes were journaled
+	def compact(self):
+		if self._journaling and self._changes:
+			self.write_perms()
+
+	# Append a change to the journal, instead of rewriting the whole file
+	def _journal(self, op, t):
+		if not self._journaling:
+			return
+
+		try:
+			with open(self.path + ".journal", "a") as f:
+				f.write(json.dumps([op] + list(t)) + "\n")
+		except Exception as e: # pragma: no cover
+			self.log.error("Error journaling permissions: {}".format(e))
+			return
+
+		self._changes += 1
+		if self._changes >= self.COMPACT_EVERY:
+			self.write_perms()
+
 	def grantPermission(self, ri, identity, perm):
 		if not self.enabled:
 			return
 
 		t = (ri, identity, perm)
-		if t not in self.perms:
-			self.perms.append(t)
+		with self._lock:
+			if t in self._rules:
+				return
+			# Copied and swapped, checks on other threads keep a consistent index
+			rules = self._rules.copy()
+			rules.add(t)
+			self._swap(rules)
+			self._changed("+", t)
 
 	def revokePermission(self, ri, identity, perm):
 		if not self.enabled:
 			return
 
-		try:
-			self.perms.remove((ri,identity, perm))
-		except Exception as e:
-			self.log.error("Revocation failed: {}".format(e))
+		t = (ri, identity, perm)
+		with self._lock:
+			rules = self._rules.copy()
+			try:
+				rules.remove(t)
+			except Exception as e:
+				self.log.error("Revocation failed: {}".format(e))
+				return
+			self._swap(rules)
+			self._changed("-", t)
+
+	# Journal a change, and remember it for a reload already parsing the file
+	def _changed(self, op, t):
+		if self._reloading:
+			self._since_reload.append((op, t))
+		self._journal(op, t)
 
 	def hasPermission(self, ri, identity, perm, permissive=True):
 		if not self.enabled:
 			return permissive
 
-		def tester(x):
-			a,b,c = x
-			return re.match(a, ri) and b in (identity, "*") and re.match(c, perm)
+		# Read once, so a concurrent reload can't mix old and new rules
+		rules = self._rules
 
-		# Return True on the first successful perm match
-		for l in self.perms:
-			if tester(l):
-				return True
-		return False
+		key = (ri, identity, perm)
+		decision = rules.decisions.get(key)
+		if decision is None:
+			decision = rules.match(ri, identity, perm)
+			rules.decisions.put(key, decision)
+		return decision
@@ -5,9 +5,13 @@
 import json
 import threading
 import asyncio
+import concurrent.futures
+import time
 import os, sys
 import importlib
 import collections
+import copy
+import types
 import halibot.packages
 try:
 	from packaging.version import Version
@@ -17,7 +21,13 @@ from queue import Queue,Empty
 from string import Template
 from .halmodule import HalModule
 from .halagent import HalAgent
+from .halfilter import HalFilter
+from .lazymodule import LazyModule
 from .halauth import HalAuth
+from .routetable import RouteTable
+from .dispatchindex import DispatchIndex
+from .pkgindex import PackageIndex
+from .profiler import StartupProfile
 
 # Avoid appending "." if it i
 if "." not in sys.path:
@@ -26,41 +36,118 @@ import logging
 
 HALDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 
+#
+# Name -> HalObject map, with live per-kind indexes kept up to date on every
+#  insert and delete
+#
 class ObjectDict(dict):
 
-	@property
-	def modules(self):
-		return dict(filter(lambda x: isinstance(x[1], HalModule), self.items()))
+	def __init__(self, *args, **kwargs):
+		super().__init__()
+		self._modules = {}
+		self._agents = {}
+		self._filters = {}
+
+		# Read-only views of the indexes
+		self.modules = types.MappingProxyType(self._modules)
+		self.agents = types.MappingProxyType(self._agents)
+		self.filters = types.MappingProxyType(self._filters)
+
+		# Bumped on every change, for caches derived from the loaded objects
+		self.generation = 0
+
+		self.update(*args, **kwargs)
+
+	def _index_for(self, obj):
+		if isinstance(obj, HalModule): return self._modules
+		if isinstance(obj, HalAgent): return self._agents
+		if isinstance(obj, HalFilter): return self._filters
+		return None
+
+	def _unindex(self, key):
+		idx = self._index_for(self[key])
+		if idx is not None:
+			del idx[key]
+
+	def __setitem__(self, key, obj):
+		idx = self._index_for(obj)
+		if key in self and self._index_for(self[key]) is not idx:
+			self._unindex(key)
+		super().__setitem__(key, obj)
+		if idx is not None:
+			idx[key] = obj
+		self.generation += 1
+
+	def __delitem__(self, key):
+		self._unindex(key)
+		super().__delitem__(key)
+		self.generation += 1
+
+	def pop(self, key, *default):
+		if key not in self:
+			return super().pop(key, *default)
+		obj = self[key]
+		del self[key]
+		return obj
+
+	def popitem(self):
+		if not self:
+			raise KeyError("popitem(): dictionary is empty")
+		key = list(self)[-1] # Dict views are only reversible since 3.8
+		return key, self.pop(key)
 
-	@property
-	def agents(self):
-		return dict(filter(lambda x: isinstance(x[1], HalAgent), self.items()))
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
+		return self[key]
+
+	def update(self, *args, **kwargs):
+		for k, v in dict(*args, **kwargs).items():
+			self[k] = v
+
+	def clear(self):
+		super().clear()
+		self._modules.clear()
+		self._agents.clear()
+		self._filters.clear()
+		self.generation += 1
+
+	# Mark the objects as changed without inserting or deleting any
+	def touch(self):
+		self.generation += 1
 
 #
 # This class represents the hierarchy of config files
 #
 class Config(collections.abc.MutableMapping):
 
-	def __init__(self):
+	def __init__(self, profile=None):
 		self.local = {}
 		self.system = {}
+		self.profile = profile or StartupProfile(enabled=False)
 
-	def _load_config(self, workdir="."):
+		# Bumped whenever routing relevant keys change, see RouteTable
+		self.generation = 0
+
+	def _read_config(self, path):
 		# Special values expanded inside of configs
 		specials = {
 			'HALDIR': HALDIR
 		}
 
-		with open(os.path.join(workdir, "config.json"), "r") as f:
-			text = Template(f.read()).safe_substitute(**specials)
-			self.set_local(json.loads(text))
+		with open(path, "r") as f:
+			text = f.read()
+		with self.profile.phase("template", path):
+			text = Template(text).safe_substitute(**specials)
+		return json.loads(text)
+
+	def _load_config(self, workdir="."):
+		self.set_local(self._read_config(os.path.join(workdir, "config.json")))
 
 		try:
-			with open(os.path.join(HALDIR, "config", "system.json")) as f:
-				text = Template(f.read()).safe_substitute(**specials)
-				self.set_system(json.loads(text))
+			self.set_system(self._read_config(os.path.join(HALDIR, "config", "system.json")))
 		except FileNotFoundError as _:
-			self.log.info("No system config loaded.")
+			logging.getLogger("Config").info("No system config loaded.")
 
 	def _write_config(self, workdir="."):
 		with open(os.path.join(workdir, "config.json"), "w") as f:
@@ -73,21 +160,30 @@ class Config(collections.abc.MutableMapping):
 
 	def set_local(self, local):
 		self.local = local
+		self.generation += 1
 		self._refresh_packages()
 
 	def set_system(self, system):
 		self.system = system
+		self.generation += 1
 		self._refresh_packages()
 
+	def _is_routing_key(self, key):
+		return key == "filters" or key.endswith("-instances")
+
 	def __getitem__(self, key):
 		if key in self.local: return self.local[key]
 		return self.system[key]
 
 	def __setitem__(self, key, value):
 		self.local[key] = value
+		if self._is_routing_key(key):
+			self.generation += 1
 
 	def __delitem__(self, key):
-		del self.local[value]
+		del self.local[key]
+		if self._is_routing_key(key):
+			self.generation += 1
 
 	def __iter__(self):
 		return iter(self.local.keys() + self.system.keys())
@@ -111,24 +207,49 @@ class Halibot():
 		self.use_config = kwargs.get("use_config", True)
 		self.workdir = kwargs.get("workdir", ".")
 
+		# Timings of startup, see StartupProfile
+		self.profile = kwargs.get("profile") or StartupProfile(enabled=False)
+
 		self.auth = HalAuth()
 		self.objects = ObjectDict()
-		self.config = Config()
+		self.config = Config(self.profile)
+		self.routes = RouteTable(self)
+		self.dispatch_index = DispatchIndex(self)
+		self.package_index = PackageIndex()
+
+		# (instance name, Message) refused by inboxes using the dead-letter policy
+		self.dead_letters = collections.deque(maxlen=1000)
 
 		self.eventloop = asyncio.SelectorEventLoop()
 		self._thread = None
 
+		# Held while changing which instances are registered
+		self._registry_lock = threading.RLock()
+
+		# Instance sections of config.json as last applied, see reload_config
+		self._instance_confs = {}
+		self._config_stat = None
+		self._config_reloading = False
+		self._config_loaded = False # Already read, e.g. by main.py before start
+
 	# Start the Hal instance
 	def start(self, block=True):
 		self.running = True
 
 		if self.use_config:
-			self.config._load_config()
-			self._instantiate_objects("agent")
-			self._instantiate_objects("module")
-			self._instantiate_objects("filter")
+			if not self._config_loaded:
+				self._load_config()
+			self._instantiate_objects()
+			self.profile.finish()
 			if self.config.get("use-auth", False):
 				self.auth.load_perms(self.config.get("auth-path","permissions.json"))
+				interval = self.config.get("auth-reload-interval", 5)
+				if interval:
+					self.auth.watch(self.eventloop, interval)
+
+			interval = self.config.get("config-reload-interval", 5)
+			if interval:
+				self.watch_config(interval)
 
 		if block:
 			self.eventloop.run_forever()
@@ -146,6 +267,9 @@ class Halibot():
 		for o in self.objects.values():
 			o._shutdown()
 
+		self.auth.unwatch()
+		self.auth.compact()
+
 		self.eventloop.call_soon_threadsafe(self.eventloop.stop)
 		self.log.info("Halibot shutdown. Threads left: " + str(threading.active_count()))
 		if self._thread:
@@ -154,34 +278,282 @@ class Halibot():
 		self.running = False
 
 	def _check_version(self, obj):
+		attrs = { k: getattr(obj, k) for k in ("HAL_MINIMUM", "HAL_MAXIMUM") if hasattr(obj, k) }
+		return self._check_version_attrs(getattr(obj, "__name__", obj.__class__.__name__), attrs)
+
+	# Version check on the HAL_MINIMUM/HAL_MAXIMUM of the class called name.
+	#  warn is off for checks of the source, the imported class warns later.
+	def _check_version_attrs(self, name, attrs, warn=True):
 		v = Version(self.VERSION)
-		if not hasattr(obj, "HAL_MINIMUM"):
-			self.log.warn("Module class '{}' does not define a minimum version, trying to load anyway...".format(obj.__class__.__name__))
+		if "HAL_MINIMUM" not in attrs:
+			if warn:
+				self.log.warning("Module class '{}' does not define a minimum version, trying to load anyway...".format(name))
 			return True
 
-		if v < Version(obj.HAL_MINIMUM):
-			self.log.error("Rejecting load of '{}', requires minimum Halibot version '{}'. (Currently running '{}')".format(obj.__class__.__name__, obj.HAL_MINIMUM, self.VERSION))
+		if v < Version(attrs["HAL_MINIMUM"]):
+			self.log.error("Rejecting load of '{}', requires minimum Halibot version '{}'. (Currently running '{}')".format(name, attrs["HAL_MINIMUM"], self.VERSION))
 			return False
 
-		if hasattr(obj, "HAL_MAXIMUM"):
-			if v >= Version(obj.HAL_MAXIMUM):
-				self.log.error("Rejecting load of '{}', requires maximum Halibot version '{}'. (Currently running '{}')".format(obj.__class__.__name__, obj.HAL_MAXIMUM, self.VERSION))
+		if "HAL_MAXIMUM" in attrs:
+			if v >= Version(attrs["HAL_MAXIMUM"]):
+				self.log.error("Rejecting load of '{}', requires maximum Halibot version '{}'. (Currently running '{}')".format(name, attrs["HAL_MAXIMUM"], self.VERSION))
 				return False
 		return True
 
 	def add_instance(self, name, inst):
-		self.objects[name] = inst
-		inst.name = name
-		inst.log.name += "({})".format(name)
+		self._register(name, inst)
+		self._init_instance(name, inst)
+
+		# Command tables are set up in init()
+		self.dispatch_index.invalidate()
+
+	def _register(self, name, inst, shutdown_old=True):
+		with self._registry_lock:
+			old = self.objects.get(name)
+			if shutdown_old and old and old is not inst:
+				self._shutdown_instance(name, old)
+
+			self.objects[name] = inst
+			self.routes.invalidate()
+		self._name_instance(name, inst)
+
+	def _name_instance(self, name, inst):
+		if getattr(inst, "name", None) != name:
+			inst.name = name
+			inst.log.name += "({})".format(name)
+
+	# Returns whether init() succeeded
+	def _init_instance(self, name, inst):
+		start = time.monotonic()
 		try:
-			inst.init()
+			with self.profile.phase("init", name):
+				inst.init()
 		except Exception as e:
 			self.log.error(f"Failed to instantiate object '{name}': {e}")
-		else:
-			self.log.info("Instantiated object '" + name + "'")
+			return False
+		inst._build_instance_receivers()
+		self.log.info("Instantiated object '{}' in {:.3f}s".format(name, time.monotonic() - start))
+		return True
+
+	# Names in confs (name -> config) that each instance's 'depends-on' names
+	def _dependencies(self, confs):
+		deps = {}
+		for name, conf in confs.items():
+			want = conf.get("depends-on", [])
+			if isinstance(want, str):
+				want = [want]
+
+			deps[name] = set()
+			for d in want:
+				if d in confs:
+					deps[name].add(d)
+				elif d not in self.objects:
+					self.log.warning("Instance '{}' depends on unknown instance '{}'".format(name, d))
+		return deps
+
+	def _construct(self, name, conf):
+		with self.profile.phase("construct", name):
+			return self._construct_instance(conf)
+
+	def _construct_instance(self, conf):
+		if conf.get("lazy"):
+			# Imported and constructed on the first message instead, but
+			#  rejected right away if the source shows it won't load
+			info = self.package_index.find(*conf["of"].split(":", 1)) if ":" in conf["of"] else None
+			if info and info.static and not self._check_version_attrs(info.name, info.attrs, warn=False):
+				return None
+			return LazyModule(self, conf=conf)
+		return self.load_object(conf["of"], conf=conf)
+
+	# Construct, register and init the instances in confs (name -> config) on
+	#  a pool of 'startup-workers' threads. Instances are registered in the
+	#  order of confs, and each is only initialized once everything in its
+	#  'depends-on' list has been. Messages for an instance are held until its
+	#  init() returned. Returns the names of the instances that constructed
+	#  and initialized.
+	def start_instances(self, confs):
+		start = time.monotonic()
+		deps = self._dependencies(confs)
+
+		# Leave out dependency cycles, and everything depending on them
+		ordered = set()
+		while True:
+			ready = [n for n in deps if n not in ordered and deps[n] <= ordered]
+			if not ready:
+				break
+			ordered.update(ready)
+		for name in deps.keys() - ordered:
+			self.log.error("Not starting instance '{}', its 'depends-on' is circular".format(name))
+
+		workers = self.config.get("startup-workers", 8)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+			futs = { name: pool.submit(self._construct, name, conf) for name, conf in confs.items() if name in ordered }
+
+			objs = {}
+			for name, fut in futs.items():
+				try:
+					obj = fut.result()
+				except Exception as e:
+					# Treated like any other failed load, the rest still start
+					self.log.error(f"Failed to instantiate object '{name}': {e}")
+					obj = None
+				if obj:
+					obj.inbox.pause()
+					self._register(name, obj)
+					objs[name] = obj
+
+			# Instances that failed to load don't hold up their dependents
+			done = set(confs) - set(objs)
+			waiting = { name: deps[name] for name in objs }
+			running = {}
+			initialized = set()
+			while waiting or running:
+				for name in [n for n, d in waiting.items() if d <= done]:
+					del waiting[name]
+					running[pool.submit(self._init_instance, name, objs[name])] = name
+
+				finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+				for f in finished:
+					name = running.pop(f)
+					done.add(name)
+					if f.result():
+						initialized.add(name)
+					objs[name].inbox.resume()
+
+		# Command tables are set up in init()
+		self.dispatch_index.invalidate()
+		self.log.info("Started {} instances in {:.3f}s".format(len(initialized), time.monotonic() - start))
+		return [name for name in objs if name in initialized]
+
+	def _shutdown_instance(self, name, inst):
+		try:
+			inst._shutdown()
+		except Exception as e:
+			self.log.error(f"Failed to shut down object '{name}': {e}")
+
+	# Shut down and drop an instance by name, returning it
+	def remove_instance(self, name):
+		inst = self.objects.pop(name, None)
+		if inst is None:
+			self.log.warning("No instance '{}' to remove".format(name))
+			return None
+
+		self._shutdown_instance(name, inst)
+		self.routes.invalidate()
+		self.dispatch_index.invalidate()
+		self.log.info("Removed object '" + name + "'")
+		return inst
+
+	def _config_path(self):
+		return os.path.join(self.workdir, "config.json")
+
+	def _config_file_stat(self):
+		try:
+			st = os.stat(self._config_path())
+		except OSError:
+			return None
+		return (st.st_mtime_ns, st.st_size)
 
 	def _load_config(self):
-		self.config._load_config(workdir=self.workdir)
+		self._config_stat = self._config_file_stat()
+		with self.profile.phase("config", self._config_path()):
+			self.config._load_config(workdir=self.workdir)
+		self._instance_confs = self._snapshot_instances(self.config)
+		self._config_loaded = True
+
+	# Deep copy, as objects are free to modify their own config
+	def _snapshot_instances(self, config):
+		return { kind: copy.deepcopy(config.get(kind + "-instances", {})) for kind in ("agent", "module", "filter") }
+
+	# Poll config.json every interval seconds, and apply changes to it
+	def watch_config(self, interval=5):
+		self._config_interval = interval
+		self.eventloop.call_soon_threadsafe(self._poll_config)
+
+	def _poll_config(self):
+		if not self.running:
+			return
+
+		st = self._config_file_stat()
+		if st and st != self._config_stat and not self._config_reloading:
+			self._config_stat = st
+			self._config_reloading = True
+			# Instantiating objects may block, keep it off the event loop
+			fut = self.eventloop.run_in_executor(None, self.reload_config)
+			fut.add_done_callback(self._config_reloaded)
+
+		self.eventloop.call_later(self._config_interval, self._poll_config)
+
+	def _config_reloaded(self, fut):
+		self._config_reloading = False
+		if fut.exception():
+			self.log.error("Error reloading config", exc_info=fut.exception())
+
+	# Re-read config.json and start, stop or restart only the instances whose
+	#  configuration changed. Returns the names of each, and of the instances
+	#  that failed to start, or None on error.
+	def reload_config(self):
+		try:
+			local = self.config._read_config(self._config_path())
+		except Exception as e:
+			self.log.error("Error reloading config, keeping the current one: {}".format(e))
+			return None
+
+		old = self._instance_confs
+		new = self._snapshot_instances(local)
+		self.config.set_local(local) # Also rebuilds routes for changed filters
+
+		changes = { "added": [], "removed": [], "restarted": [], "failed": [] }
+		oldconfs = {}
+		newconfs = {}
+		for kind in ("agent", "module", "filter"):
+			oldconfs.update(old.get(kind, {}))
+			newconfs.update(new[kind])
+
+		# Only what was applied is remembered, so instances that failed to
+		#  start are tried again on the next change
+		applied = { kind: dict(old.get(kind, {})) for kind in ("agent", "module", "filter") }
+		def forget(name):
+			for confs in applied.values():
+				confs.pop(name, None)
+
+		for name, conf in oldconfs.items():
+			if name not in newconfs:
+				self.remove_instance(name)
+				changes["removed"].append(name)
+				forget(name)
+
+		start = {}
+		kinds = {}
+		for kind in ("agent", "module", "filter"):
+			for name, conf in new[kind].items():
+				if name not in oldconfs:
+					changes["added"].append(name)
+				elif conf != oldconfs[name]:
+					changes["restarted"].append(name)
+				else:
+					continue
+				# Hand the instance a copy, leaving the snapshot untouched
+				start[name] = copy.deepcopy(conf)
+				kinds[name] = kind
+
+		running = { name: self.objects.get(name) for name in start }
+		started = self.start_instances(start) if start else []
+		for name in start:
+			if name in started:
+				forget(name)
+				applied[kinds[name]][name] = new[kinds[name]][name]
+				continue
+			changes["failed"].append(name)
+			# Drop a replacement that failed init(), an instance whose new
+			#  config didn't even construct keeps running as it was
+			obj = self.objects.get(name)
+			if obj is not None and obj is not running[name]:
+				self.remove_instance(name)
+
+		self._instance_confs = applied
+		self.log.info("Reloaded config: {added} added, {removed} removed, {restarted} restarted, {failed} failed".format(**{ k: len(v) for k, v in changes.items() }))
+		return changes
 
 	def _write_config(self):
 		self.config._write_config(workdir=self.workdir)
@@ -205,6 +577,12 @@ class Halibot():
 			split = pkg.split(":")
 
 			if len(split) == 2:
+				# Skip the import if the source already tells the version won't
+				#  do, the imported class is still checked either way
+				info = self.package_index.find(*split)
+				if info and info.static and not self._check_version_attrs(info.name, info.attrs, warn=False):
+					return None
+
 				obj = self._get_class_from_package(*split)
 				if obj and self._check_version(obj):
 						return obj(self, conf=conf)
@@ -212,27 +590,88 @@ class Halibot():
 				self.log.error("Invalid class identifier {}, must contain only 1 ':'".format(conf["of"]))
 			return None
 
-	def _instantiate_objects(self, key):
-		inst = self.config.get(key + "-instances", {})
-
-		for k in inst.keys():
-			conf = inst[k]
-			obj = self.load_object(conf["of"], conf=conf)
-
-			if obj:
-				self.add_instance(k, obj)
+	def _instantiate_objects(self, kinds=("agent", "module", "filter")):
+		confs = {}
+		for key in kinds:
+			confs.update(self.config.get(key + "-instances", {}))
+		return self.start_instances(confs)
 
 	def get_package(self, name):
-		return importlib.import_module('halibot.packages.' + name)
+		with self.profile.phase("import", name):
+			return importlib.import_module('halibot.packages.' + name)
 
+	# Reload a package and swap its instances for new ones, see async_reload.
+	#  Blocks until the swap is done, so it can't be called on the event loop.
 	def reload(self, name):
+		if asyncio._get_running_loop() is self.eventloop:
+			raise RuntimeError("reload() would block the event loop, await async_reload() instead")
+		coro = self.async_reload(name)
+		if self.eventloop.is_running():
+			return asyncio.run_coroutine_threadsafe(coro, self.eventloop).result()
+		return self.eventloop.run_until_complete(coro)
+
+	# Reload a package, and replace every instance of its classes without
+	#  losing messages. Delivery to those instances is paused and running
+	#  handlers get up to timeout seconds ('reload-timeout', 10 by default) to
+	#  finish. The replacements are then built, and each old instance is shut
+	#  down before its replacement is initialized, so resources like ports and
+	#  nicks are free again. The replacement is handed the old instance through
+	#  handover() and takes over the paused inbox. If its init() fails, the old
+	#  instance is initialized again instead.
+	async def async_reload(self, name, timeout=None):
+		if timeout is None:
+			timeout = self.config.get("reload-timeout", 10)
+
 		parent = 'halibot.packages.' + name
-		for k,o in self.objects.items():
-			if o.__module__.startswith(parent + '.') or o.__module__ == parent:
-				o._shutdown()
-				mod = importlib.reload(importlib.import_module(o.__module__))
-				cls = getattr(mod, o.__class__.__name__)
-				self.add_instance(k, cls(self, o.config))
+		olds = { k: o for k, o in self.objects.items() if o.__module__.startswith(parent + '.') or o.__module__ == parent }
+
+		for o in olds.values():
+			o.inbox.pause()
+
+		try:
+			busy = [asyncio.ensure_future(o.inbox.wait_idle()) for o in olds.values()]
+			if busy:
+				_, pending = await asyncio.wait(busy, timeout=timeout)
+				for f in pending:
+					f.cancel()
+				if pending:
+					self.log.warning("Handlers still running after {}s, reloading '{}' anyway".format(timeout, name))
+
+			# Reload every module once, then build all the replacements
+			mods = {}
+			for o in olds.values():
+				if o.__module__ not in mods:
+					mods[o.__module__] = importlib.reload(importlib.import_module(o.__module__))
+			news = { k: getattr(mods[o.__module__], o.__class__.__name__)(self, o.config) for k, o in olds.items() }
+		except BaseException:
+			# Keep the old instances running
+			for o in olds.values():
+				o.inbox.resume()
+			raise
+
+		for k, new in news.items():
+			old = olds[k]
+			self._name_instance(k, new)
+			self._shutdown_instance(k, old)
+			if not await self.eventloop.run_in_executor(None, self._init_instance, k, new):
+				# Bring the old instance back, and let its held messages through
+				self.log.error("Restarting the old '{}', its replacement failed to init".format(k))
+				self._shutdown_instance(k, new)
+				await self.eventloop.run_in_executor(None, self._init_instance, k, old)
+				self.dispatch_index.invalidate()
+				old.inbox.resume()
+				continue
+			try:
+				new.handover(old)
+			except Exception as e:
+				self.log.error("Failed to hand over '{}': {}".format(k, e))
+
+			# Messages held for the old instance go to the new one
+			new.inbox = old.inbox
+			new.inbox.obj = new
+			self._register(k, new, shutdown_old=False)
+			self.dispatch_index.invalidate()
+			new.inbox.resume()
 
 	# Restart a module instance by name
 	def restart(self, name):
@@ -240,5 +679,8 @@ class Halibot():
 		if o:
 			o.shutdown()
 			o.init()
+			o._build_instance_receivers()
+			self.dispatch_index.invalidate()
+			self.objects.touch()
 		else:
 			self.log.warning("Failed to restart instance '{}'".format(name))
@@ -3,20 +3,39 @@ from .message import Message
 
 class HalModule(HalObject):
 
-	def reply(self, msg0=None, **kwargs):
-		# Create the reply message
+	# Which agent dispatches this module wants, None for all of them. A dict
+	#  with any of the following keys, overridable by 'subscribe' in config:
+	#   types    - list of message types
+	#   prefixes - list of strings the body has to start with
+	#   patterns - list of regexes searched for in the body
+	#  A body has to match one of the prefixes or patterns, if any are given.
+	subscribe = None
+
+	def _make_reply(self, msg0, **kwargs):
 		body = kwargs.get('body', msg0.body)
 		mtype = kwargs.get('type', msg0.type)
 		author = kwargs.get('author', msg0.author)
 		origin = kwargs.get('origin', self.name)
 
-		msg = Message(body=body, type=mtype, author=author, origin=origin)
+		return Message(body=body, type=mtype, author=author, origin=origin)
+
+	def reply(self, msg0=None, **kwargs):
+		msg = self._make_reply(msg0, **kwargs)
 
 		# Synchronous reply?
 		if msg0.sync:
-			self.sync_replies[msg0.uuid].append(msg)
+			self.sync_replies.add(msg0.uuid, msg)
 		else:
 			self.send_to(msg, [ msg0.origin ])
 
+	# Awaitable reply, for use from async receive handlers
+	async def async_reply(self, msg0=None, **kwargs):
+		msg = self._make_reply(msg0, **kwargs)
+
+		if msg0.sync:
+			self.sync_replies.add(msg0.uuid, msg)
+		else:
+			await self.async_send_to(msg, [ msg0.origin ])
+
 	def hasPermission(self, msg, perm):
 		return self._hal.auth.hasPermission(msg.origin, msg.identity, perm)
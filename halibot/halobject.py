@@ -1,26 +1,110 @@
 import logging
 import asyncio
 import inspect
-import copy
 from threading import Thread
-from collections import defaultdict
 from .halconfigurer import HalConfigurer
 from .message import MalformedMsgException
+from .inbox import Inbox
+from .replystore import ReplyStore
 
 class SyncSendSelfException(Exception): 'Cannot sync_send_to oneself.'
+class SyncSendLoopException(Exception): 'Cannot block in sync_send_to on the event loop, use request instead.'
+
+# Replies to one scattered request, matched by the request's uuid
+class ReplyGather():
+
+	def __init__(self, obj, msg, futs):
+		self.obj = obj
+		self.msg = msg
+		self.futs = futs # RI -> Future resolved once the target handled msg
+
+	# Targets that have not finished handling the request
+	@property
+	def pending(self):
+		return [ri for ri, fut in self.futs.items() if fut and not fut.done()]
+
+	def _pop(self, ri):
+		to = self.obj._hal.objects.get(ri.split('/')[0])
+		# Assure that the module was not removed in the interim
+		return to.sync_replies.pop(self.msg.uuid) if to else None
+
+	def collect(self):
+		r = {}
+		for ri in self.futs.keys():
+			replies = self._pop(ri)
+			if replies:
+				r[ri] = replies
+		return r
+
+	# Wait for every target, or until timeout seconds passed, and return the
+	#  replies received so far as RI -> [Message, ...]
+	async def wait(self, timeout=None):
+		futs = [asyncio.wrap_future(f, loop=self.obj.eventloop) for f in self.futs.values() if f]
+		if futs:
+			await asyncio.wait(futs, timeout=timeout)
+		return self.collect()
+
+	# Return as soon as a target replied with a body for which accept is true,
+	#  as RI -> [Message, ...]. Empty if none did within timeout seconds.
+	async def first(self, timeout=None, accept=bool):
+		loop = self.obj.eventloop
+		waiting = { asyncio.wrap_future(f, loop=loop): ri for ri, f in self.futs.items() if f }
+		deadline = loop.time() + timeout if timeout is not None else None
+
+		while waiting:
+			remaining = max(0, deadline - loop.time()) if deadline is not None else None
+			done, _ = await asyncio.wait(waiting, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+			if not done:
+				break
+			for f in done:
+				ri = waiting.pop(f)
+				replies = self._pop(ri)
+				if replies and any(accept(r.body) for r in replies):
+					return { ri: replies }
+
+		return {}
 
 class HalObject():
 
-	def __init__(self, hal, conf={}):
+	def __init__(self, hal, conf=None):
 		self._hal = hal
-		self.config = conf
+		# Never share a default dict, agents add to their config in connect()
+		self.config = conf if conf is not None else {}
 		self.log = logging.getLogger(self.__class__.__name__)
 
 		# Only used in HalModule.reply right now, but accessed on potentially any
 		# HalObject, so it exists on every HalObject to avoid attribute errors
-		self.sync_replies = defaultdict(lambda: []) # UUID -> [Message, ...]
+		self.sync_replies = ReplyStore(ttl=hal.config.get('reply-ttl', 60), maxsize=hal.config.get('reply-store-size', 1024)) # UUID -> [Message, ...]
 
 		self.eventloop = hal.eventloop
+		self.inbox = Inbox(self, size=self.config.get('inbox-size', 0), policy=self.config.get('inbox-policy', 'block'))
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls._build_receivers()
+
+	# Map message type -> receive_<type> function, once per class
+	@classmethod
+	def _build_receivers(cls):
+		cls._receivers = {}
+		for fname in dir(cls):
+			if fname.startswith('receive_') and callable(getattr(cls, fname)):
+				func = getattr(cls, fname)
+				if isinstance(inspect.getattr_static(cls, fname), (staticmethod, classmethod)):
+					# Already bound or static, called without self
+					func = lambda self, msg, func=func: func(msg)
+				cls._receivers[fname[len('receive_'):]] = func
+
+	# Add receive_<type> functions assigned on the instance (e.g. in init) to
+	#  a table of its own, called once init() ran
+	def _build_instance_receivers(self):
+		own = { k[len('receive_'):]: v for k, v in self.__dict__.items() if k.startswith('receive_') and callable(v) }
+		if own:
+			self._receivers = dict(type(self)._receivers)
+			for t, func in own.items():
+				self._receivers[t] = lambda self, msg, func=func: func(msg)
+		else:
+			self.__dict__.pop('_receivers', None)
 
 	def _run_eventloop(self):
 		self.eventloop.run_forever()
@@ -29,9 +113,11 @@ class HalObject():
 	def _shutdown(self):
 		self.shutdown()
 
-	def _queue_msg(self, msg):
-		fut = asyncio.run_coroutine_threadsafe(self._receive(msg), self.eventloop)
-		return fut
+	def _on_loop(self):
+		return asyncio._get_running_loop() is self.eventloop
+
+	def _queue_msg(self, msg, pipeline=()):
+		return self.inbox.put(msg, pipeline)
 
 	def init(self):
 		pass
@@ -39,22 +125,27 @@ class HalObject():
 	def shutdown(self):
 		pass
 
-	def apply_filter(self, dest):
-		fl = self._hal.config.get("filters")
-		if not fl:
-			return dest # Filters not enabled/configured
-
-		name = dest.split("/")[0]
-
-		ib = fl.get("inbound", {})
-		ob = fl.get("outbound", {})
-
-		ret = "/".join(ib.get(name, []) + [dest])
-		ret = "/".join(ob.get(self.name, []) + [ret])
-
-		return ret
+	# Called on a replacement for old (e.g. by Halibot.reload) after init, and
+	#  before it gets any messages. old is already shut down by then. Carry
+	#  over whatever state is worth keeping.
+	def handover(self, old):
+		pass
 
-	def raw_send(self, msg):
+	def apply_filter(self, dest):
+		return self._hal.routes.resolve(self.name, dest).target
+
+	# Point msg at ri, returning the fused filter pipeline to run on delivery
+	def _route(self, msg, ri):
+		route = self._hal.routes.resolve(self.name, ri)
+		if route.pipeline is None:
+			# Hop through each filter in turn
+			msg.target = route.target
+			return ()
+		msg.target = ri
+		return route.pipeline
+
+	# pipeline is a Route.pipeline of filters to run before delivery
+	def raw_send(self, msg, pipeline=()):
 		if not msg.target:
 			self.log.warning("Message passed to send without target")
 			raise MalformedMsgException("raw_send given empty target")
@@ -65,8 +156,8 @@ class HalObject():
 		name = msg.target.split("/")[0]
 		to = self._hal.objects.get(name)
 		if to:
-			nmsg = copy.copy(msg)
-			return to._queue_msg(nmsg)
+			# Shallow copy, fields are shared and misc is copied on write
+			return to._queue_msg(msg.__copy__(), pipeline)
 		else:
 			self.log.warning("Unknown module/agent: " + name)
 
@@ -78,39 +169,78 @@ class HalObject():
 
 		ret = {}
 		for ri in dests:
-			msg.target = self.apply_filter(ri)
-			ret[ri] = self.raw_send(msg)
+			pipeline = self._route(msg, ri)
+			ret[ri] = self.raw_send(msg, pipeline)
+
+		return ret
+
+	# Awaitable send_to, waits for room in each destination's inbox
+	async def async_send_to(self, msg, dests):
+		if msg.origin == None:
+			msg.origin = self.name
+
+		ret = {}
+		for ri in dests:
+			pipeline = self._route(msg, ri)
+			to = self._hal.objects.get(msg.target.split("/")[0])
+			if to:
+				await to.inbox.wait_space()
+			ret[ri] = self.raw_send(msg, pipeline)
 
 		return ret
 
-	def sync_send_to(self, msg, dests):
+	def _check_sync_dests(self, dests):
 		# Check for potential deadlocks
 		for ri in dests:
 			if ri.split('/')[0] == self.name:
 				raise SyncSendSelfException
 
+	# Send msg to every dest at once, returning a ReplyGather for the replies
+	def scatter(self, msg, dests):
+		self._check_sync_dests(dests)
 		msg.sync = True
+		return ReplyGather(self, msg, self.send_to(msg, dests))
 
-		futs = self.send_to(msg, dests)
+	# Awaitable request/reply, returns RI -> [Message, ...]. Once timeout
+	#  seconds passed, only the replies received so far are returned.
+	async def request(self, msg, dests, timeout=None):
+		return await self.scatter(msg, dests).wait(timeout)
 
-		r = {}
-		for name, fut in futs.items():
-			fut.result()
-			to = self._hal.objects.get(name)
-			if to and msg.uuid in to.sync_replies:
-				# Assure that the module was not removed in the interim
-				r[name] = to.sync_replies.pop(msg.uuid)
-		return r
+	# Blocking request/reply for threads other than the event loop
+	def sync_send_to(self, msg, dests, timeout=None):
+		self._check_sync_dests(dests)
+		if self._on_loop():
+			raise SyncSendLoopException
+
+		fut = asyncio.run_coroutine_threadsafe(self.request(msg, dests, timeout=timeout), self.eventloop)
+		return fut.result()
 
 	async def _receive(self, msg):
+		aw = self._dispatch(msg)
+		if aw:
+			await self._await_handler(aw)
+
+	# Call the handler for msg, returning its awaitable if it is a coroutine
+	def _dispatch(self, msg):
+		handler = self._receivers.get(msg.type)
 		try:
-			fname = 'receive_' + msg.type
-			if hasattr(self, fname) and callable(getattr(self, fname)):
+			if handler:
 				# Type specific receive function
-				getattr(self, fname)(msg)
+				ret = handler(self, msg)
 			else:
 				# Generic receive function
-				self.receive(msg)
+				ret = self.receive(msg)
+		except Exception as e:
+			self.log.error("Exception in message receive", exc_info=True)
+			return None
+
+		if ret is not None and inspect.isawaitable(ret):
+			return ret
+		return None
+
+	async def _await_handler(self, aw):
+		try:
+			await aw
 		except Exception as e:
 			self.log.error("Exception in message receive", exc_info=True)
 
@@ -145,3 +275,5 @@ class HalObject():
 
 	def invoke(self, inst, method, *args, **kwargs):
 		return getattr(self._hal.objects[inst], method)(*args, **kwargs)
+
+HalObject._build_receivers()
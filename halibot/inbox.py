@@ -0,0 +1,225 @@
+#
+# Inbox
+#    Bounded per-object message queue, drained in batches on the event loop
+#
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+from .message import MalformedMsgException
+
+# asyncio.current_task is new in 3.7, Task.current_task is gone since 3.9
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+class Inbox():
+
+	POLICIES = ('block', 'drop-oldest', 'drop-newest', 'dead-letter')
+
+	# Maximum messages handled per loop callback, so one busy object can't
+	#  starve everything else scheduled on the loop
+	BATCH = 64
+
+	# The bound counts both queued messages and async handlers still running
+	def __init__(self, obj, size=0, policy='block'):
+		if policy not in self.POLICIES:
+			raise ValueError("Unknown inbox policy '{}'".format(policy))
+
+		self.obj = obj
+		self.size = size # 0 means unbounded
+		self.policy = policy
+		self.log = logging.getLogger(self.__class__.__name__)
+
+		# Outcome counters
+		#  accepted       - queued for delivery
+		#  blocked        - sender had to wait for space (block policy, or async_send_to)
+		#  overflowed     - queued past the bound, sender runs on the loop and cannot block
+		#  dropped-oldest - evicted to make room for a newer message
+		#  dropped-newest - refused because the inbox was full
+		#  dead-lettered  - refused and handed to the dead letter sink
+		self.stats = dict.fromkeys(('accepted', 'blocked', 'overflowed', 'dropped-oldest', 'dropped-newest', 'dead-lettered'), 0)
+
+		self._queue = collections.deque() # (Message, Future or None, filter pipeline)
+		self._inflight = 0
+		self._tasks = set() # Running async handlers
+		self._waiters = [] # asyncio futures of senders awaiting space, or idleness
+		self._scheduled = False
+		self._paused = False
+		self._lock = threading.Lock()
+		self._space = threading.Condition(self._lock)
+
+	def __len__(self):
+		return len(self._queue)
+
+	def _full(self):
+		return self.size and len(self._queue) + self._inflight >= self.size
+
+	def _resolve(self, fut):
+		if fut and not fut.done():
+			fut.set_result(None)
+
+	# Wake every coroutine waiting in wait_space or wait_idle, must run on the loop
+	def _wake(self):
+		waiters, self._waiters = self._waiters, []
+		for w in waiters:
+			if not w.done():
+				w.set_result(None)
+
+	# Wait on the loop until the inbox has room, the awaitable form of block
+	async def wait_space(self):
+		if self._full():
+			self.stats['blocked'] += 1
+		while self._full():
+			w = self.obj.eventloop.create_future()
+			self._waiters.append(w)
+			await w
+
+	# Stop handling messages, they keep being queued until resume
+	def pause(self):
+		with self._lock:
+			self._paused = True
+
+	def resume(self):
+		with self._lock:
+			self._paused = False
+			schedule = len(self._queue) > 0 and not self._scheduled
+			self._scheduled = self._scheduled or schedule
+
+		if schedule:
+			self.obj.eventloop.call_soon_threadsafe(self._drain)
+
+	# Wait on the loop until no handler is running, other than the caller's
+	async def wait_idle(self):
+		me = current_task(self.obj.eventloop)
+		while self._inflight > (1 if me in self._tasks else 0):
+			w = self.obj.eventloop.create_future()
+			self._waiters.append(w)
+			await w
+
+	# Apply the overflow policy, must hold the lock.
+	#  Returns False if the new message should not be queued.
+	def _overflow(self, msg, on_loop):
+		if self.policy == 'block':
+			if on_loop:
+				# Blocking here would deadlock the loop that drains us
+				self.stats['overflowed'] += 1
+				return True
+			self.stats['blocked'] += 1
+			loop = self.obj.eventloop
+			while self._full() and loop.is_running():
+				self._space.wait(0.5)
+			return True
+
+		if self.policy == 'drop-oldest' and self._queue:
+			_, old, _ = self._queue.popleft()
+			self._resolve(old)
+			self.stats['dropped-oldest'] += 1
+			return True
+
+		if self.policy in ('drop-oldest', 'drop-newest'):
+			# Nothing queued to drop when only running handlers fill the inbox
+			self.stats['dropped-newest'] += 1
+		else:
+			self.stats['dead-lettered'] += 1
+			self.obj._hal.dead_letters.append((self.obj.name, msg))
+		self.log.debug("Inbox of '{}' full, refused message".format(self.obj.name))
+		return False
+
+	# Queue a message for delivery, callable from any thread.
+	#  pipeline holds filters to run right before handling, see RouteTable.
+	#  Returns a Future resolved after handling for sync messages, else None.
+	def put(self, msg, pipeline=()):
+		loop = self.obj.eventloop
+		on_loop = self.obj._on_loop()
+		fut = concurrent.futures.Future() if msg.sync else None
+
+		with self._lock:
+			if self._full() and not self._overflow(msg, on_loop):
+				self._resolve(fut)
+				return fut
+
+			self._queue.append((msg, fut, pipeline))
+			self.stats['accepted'] += 1
+			schedule = not self._scheduled and not self._paused
+			self._scheduled = self._scheduled or schedule
+
+		if schedule:
+			if on_loop:
+				loop.call_soon(self._drain)
+			else:
+				loop.call_soon_threadsafe(self._drain)
+		return fut
+
+	def _drain(self):
+		with self._lock:
+			if self._paused:
+				self._scheduled = False
+				return
+			items = [self._queue.popleft() for _ in range(min(self.BATCH, len(self._queue)))]
+			self._inflight += len(items)
+			self._scheduled = len(self._queue) > 0
+
+		if self._scheduled:
+			self.obj.eventloop.call_soon(self._drain)
+
+		done = 0
+		try:
+			for msg, fut, pipeline in items:
+				try:
+					if pipeline:
+						msg = self._filter(msg, pipeline)
+						if not msg:
+							self._resolve(fut)
+							done += 1
+							continue
+
+					aw = self.obj._dispatch(msg)
+				except Exception as e:
+					# Only this message is lost, the rest of the batch goes on
+					self.log.error("Exception delivering message to '{}'".format(self.obj.name), exc_info=True)
+					aw = None
+
+				if aw:
+					task = self.obj.eventloop.create_task(self.obj._await_handler(aw))
+					self._tasks.add(task)
+					task.add_done_callback(lambda t, fut=fut: self._handled(t, fut))
+				else:
+					self._resolve(fut)
+					done += 1
+		finally:
+			# Handlers still running release themselves in _handled
+			if done:
+				self._release(done)
+
+	# Run a fused filter pipeline inline, returning the message to deliver or
+	#  None if a filter rejected or redirected it
+	def _filter(self, msg, pipeline):
+		for f, target in pipeline:
+			msg.target = target
+			try:
+				msg = f.filter(msg)
+			except Exception as e:
+				f.log.error("Exception in message filter", exc_info=True)
+				return None
+
+			if not msg:
+				return None
+			if msg.target != target:
+				# The filter redirected the message, hop from there as before
+				try:
+					f.raw_send(msg)
+				except MalformedMsgException as e:
+					f.log.error("Filter redirected a malformed message: {}".format(e))
+				return None
+		return msg
+
+	def _handled(self, task, fut):
+		self._tasks.discard(task)
+		self._resolve(fut)
+		self._release(1)
+
+	def _release(self, count):
+		with self._lock:
+			self._inflight -= count
+			self._space.notify_all()
+		self._wake()
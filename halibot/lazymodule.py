@@ -0,0 +1,124 @@
+#
+# LazyModule
+#    Placeholder registered for module instances configured as 'lazy'. The
+#    real module is only imported and initialized once a message reaches it.
+#    Help is answered by the placeholder where it can, without loading it.
+#
+from .halmodule import HalModule
+
+# Overriding any of these makes a CommandModule see every message, as in
+#  DispatchIndex._wants_raw
+RAW_METHODS = ('receive', 'receive_simple', '_cmd_receive', '_cmd_parse', 'default')
+
+class LazyModule(HalModule):
+
+	def init(self):
+		self._obj = None # The real module while it is loaded
+		self._loading = None # asyncio future of the real module
+		self._pending = [] # (Message, asyncio future) arrived while loading
+		self._accepted = None
+
+		# Topic -> help text (None if only the module has it), read from the
+		#  source until the module was loaded, then taken from the module
+		if getattr(self, "_topics", None) is None:
+			of = self.config["of"]
+			info = self._hal.package_index.find(*of.split(":", 1)) if ":" in of else None
+			self._topics = dict(info.topics or {}) if info else {}
+			self.subscribe = self._subscription(info)
+
+	# What the dispatch index should wake the module for, read from the source
+	#  as the real module's subscription and commands aren't known until then.
+	#  None wakes it for every message.
+	def _subscription(self, info):
+		if info is None:
+			return None
+		if info.subscribe is not None:
+			return info.subscribe
+		if info.commands and not info.methods.intersection(RAW_METHODS):
+			return { "types": ["simple"], "prefixes": [self._hal.config.get("command_prefix", "!")] }
+		return None
+
+	# Construct and init the real module, registered later on the loop
+	def _load(self):
+		obj = self._hal.load_object(self.config["of"], conf=self.config)
+		if obj:
+			self._hal._name_instance(self.name, obj)
+			self._hal._init_instance(self.name, obj)
+		return obj
+
+	# Messages wait here until the real module is loaded, returning a future
+	#  resolved once it handled them
+	def _dispatch(self, msg):
+		if self._obj:
+			# Queued to the placeholder before it was replaced
+			return self._obj._dispatch(msg)
+		if msg.type == "help" and not self._help_needs_module(msg):
+			return super()._dispatch(msg)
+
+		fut = self.eventloop.create_future()
+		self._pending.append((msg, fut))
+		if not self._loading:
+			self.log.info("Loading '{}' on first use".format(self.name))
+			self._loading = self.eventloop.run_in_executor(None, self._load)
+			self._loading.add_done_callback(self._loaded)
+		return fut
+
+	def _help_needs_module(self, msg):
+		key = "/".join(msg.body)
+		return msg.body != [] and key in self._topics and self._topics[key] is None
+
+	def receive_help(self, msg):
+		if msg.body == []:
+			self.reply(msg, body=list(self._topics.keys()))
+		else:
+			t = self._topics.get("/".join(msg.body))
+			if t is not None:
+				self.reply(msg, body=t() if callable(t) else t)
+
+	def _loaded(self, fut):
+		pending, self._pending = self._pending, []
+		self._obj = fut.result() if not fut.exception() else None
+
+		if self._obj is None:
+			self.log.error("Could not load '{}', dropped {} messages".format(self.name, len(pending)))
+			self._loading = None # Try again on the next message
+			for msg, f in pending:
+				f.set_result(None)
+			return
+
+		# Replace this placeholder, and hand everything over in arrival order
+		#  before anything sent to the real module directly can be handled
+		self._topics = dict(getattr(self._obj, "topics", {}))
+		self._hal._register(self.name, self._obj)
+		self._hal.dispatch_index.invalidate()
+		for msg, f in pending:
+			aw = self._obj._dispatch(msg)
+			if aw:
+				task = self.eventloop.create_task(self._obj._await_handler(aw))
+				task.add_done_callback(lambda t, f=f: f.set_result(None))
+			else:
+				f.set_result(None)
+
+		timeout = self.config.get("idle-timeout")
+		if timeout:
+			self._accepted = None
+			self.eventloop.call_later(timeout, self._check_idle, timeout)
+
+	# Put the placeholder back once the real module saw no messages between
+	#  two checks, timeout seconds apart
+	def _check_idle(self, timeout):
+		obj = self._hal.objects.get(self.name)
+		if not self._obj or not obj or obj is self or obj.config is not self.config:
+			return # Unloaded, removed or replaced by another config since
+		# A package reload swaps the instance, but keeps its config and inbox
+		self._obj = obj
+
+		accepted = obj.inbox.stats['accepted']
+		if accepted != self._accepted or len(obj.inbox) or obj.inbox._inflight:
+			self._accepted = accepted
+			self.eventloop.call_later(timeout, self._check_idle, timeout)
+			return
+
+		# Re-registering shuts the real module down, and resets this placeholder
+		self.log.info("Unloading '{}', idle for {}s".format(self.name, timeout))
+		self._hal.add_instance(self.name, self)
@@ -1,3 +1,4 @@
+import copy
 import logging
 import uuid
 from .jsdict import jsdict
@@ -6,18 +7,75 @@ class MalformedMsgException(Exception): 'Bad message object'
 
 class Message():
 
-	def __init__(self, **kwargs):
-		self.log = logging.getLogger(self.__class__.__name__)
-		self.uuid = uuid.uuid4()
+	# Copies share every field. misc is mutable, so it is copied on write:
+	#  _shared marks a misc that other copies still reference
+	__slots__ = ('body', 'type', 'author', 'identity', 'origin', 'target', 'sync', '_uuid', '_misc', '_shared')
+
+	log = logging.getLogger('Message')
+
+	def __init__(self, body=None, type='simple', author=None, identity=None, origin=None, misc=None, target='', **kwargs):
 		self.sync = False
+		self._uuid = None # Generated on first use
+		self._misc = misc # Allocated on first use
+		self._shared = False
+
+		self.body = body
+		self.type = type
+		self.author = author
+		self.identity = identity
+		self.origin = origin
+		self.target = target
+
+	@property
+	def uuid(self):
+		if self._uuid is None:
+			self._uuid = uuid.uuid4()
+		return self._uuid
+
+	@uuid.setter
+	def uuid(self, value):
+		self._uuid = value
+
+	# misc can be written through the returned object, so a shared misc is
+	#  copied the first time this message hands it out
+	@property
+	def misc(self):
+		if self._shared:
+			self._shared = False
+			self._misc = copy.copy(self._misc)
+		if self._misc is None:
+			self._misc = jsdict()
+		return self._misc
+
+	@misc.setter
+	def misc(self, value):
+		self._misc = value
+		self._shared = False
+
+	def __copy__(self):
+		# Copies of a sync message must answer to the same uuid
+		if self.sync and self._uuid is None:
+			self._uuid = uuid.uuid4()
+
+		new = self.__class__.__new__(self.__class__)
+		new.sync = self.sync
+		new._uuid = self._uuid
+		new._misc = self._misc
+		new._shared = self._shared = self._misc is not None
+		new.body = self.body
+		new.type = self.type
+		new.author = self.author
+		new.identity = self.identity
+		new.origin = self.origin
+		new.target = self.target
+		return new
 
-		self.body = kwargs.get('body', None)
-		self.type = kwargs.get('type', 'simple')
-		self.author = kwargs.get('author', None)
-		self.identity = kwargs.get('identity', None)
-		self.origin = kwargs.get('origin', None)
-		self.misc = kwargs.get('misc', jsdict())
-		self.target = kwargs.get('target', '')
+	# Copy of this message with the given fields replaced
+	def derive(self, **changes):
+		new = self.__copy__()
+		for k, v in changes.items():
+			setattr(new, k, v)
+		return new
 
 	def whom(self):
 		return '/'.join(self.target.split('/')[1:])
@@ -0,0 +1,264 @@
+#
+# PackageIndex
+#    What the installed packages contain (classes, the kind of object they
+#    make, VERSION, HAL_MINIMUM and HAL_MAXIMUM), found by parsing the package
+#    source instead of importing it. Kept until the parsed files change.
+#
+import ast
+import logging
+import os
+import halibot.packages
+
+# Halibot base classes, and the kind of instance subclasses make
+BASES = {
+	'HalObject': None,
+	'HalModule': 'module',
+	'CommandModule': 'module',
+	'HalAgent': 'agent',
+	'HalFilter': 'filter',
+}
+
+# Class attributes read from the source
+ATTRS = ('VERSION', 'HAL_MINIMUM', 'HAL_MAXIMUM')
+
+class ClassInfo():
+
+	def __init__(self, name, bases):
+		self.name = name
+		self.bases = bases # Base class names, as written
+		self.attrs = {} # Literal values of ATTRS, inherited ones included
+		self.dynamic = set() # ATTRS assigned something other than a literal
+		# Literal keys of a topics dict -> literal help text, or None if it
+		#  is only known once imported. None if there is no such dict.
+		self.topics = None
+		self.subscribe = None # Literal subscribe attribute, None if there is none
+		self.methods = set() # Names of the methods defined, inherited ones included
+		self.commands = False # Whether it is a CommandModule
+		self.kind = None
+		# Whether attrs is known to match the class once imported, i.e. every
+		#  base was found and no attribute is computed
+		self.static = False
+		self.resolved = False
+
+	@property
+	def version(self):
+		return self.attrs.get('VERSION')
+
+# Top-level classes, relative imports and aliases of one source file
+class SourceFile():
+
+	def __init__(self, path):
+		self.path = path
+		self.classes = {} # name -> ClassInfo
+		self.imports = {} # local name -> (module, name) imported from '.module'
+		self.aliases = {} # local name -> other local name
+
+		with open(path, "rb") as f:
+			tree = ast.parse(f.read(), path)
+
+		for node in tree.body:
+			if isinstance(node, ast.ClassDef):
+				self._add_class(node)
+			elif isinstance(node, ast.ImportFrom) and node.level == 1:
+				for a in node.names:
+					self.imports[a.asname or a.name] = (node.module, a.name)
+			elif isinstance(node, ast.Assign) and isinstance(node.value, ast.Name):
+				for t in node.targets:
+					if isinstance(t, ast.Name):
+						self.aliases[t.id] = node.value.id
+
+	def _add_class(self, node):
+		bases = []
+		for b in node.bases:
+			if isinstance(b, ast.Name):
+				bases.append(b.id)
+			elif isinstance(b, ast.Attribute):
+				bases.append(b.attr) # e.g. halibot.HalModule
+			else:
+				bases.append(None)
+
+		info = self.classes[node.name] = ClassInfo(node.name, bases)
+		for stmt in node.body:
+			if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef)):
+				info.methods.add(stmt.name)
+			if not isinstance(stmt, ast.Assign):
+				continue
+			for t in stmt.targets:
+				if isinstance(t, ast.Name) and t.id in ATTRS:
+					try:
+						info.attrs[t.id] = ast.literal_eval(stmt.value)
+					except ValueError:
+						info.dynamic.add(t.id)
+				elif isinstance(t, ast.Name) and t.id == 'topics' and isinstance(stmt.value, ast.Dict):
+					info.topics = self._topics(stmt.value)
+				elif isinstance(t, ast.Name) and t.id == 'subscribe':
+					try:
+						info.subscribe = ast.literal_eval(stmt.value)
+					except ValueError:
+						pass
+
+	def _topics(self, node):
+		topics = {}
+		for k, v in zip(node.keys, node.values):
+			try:
+				key = ast.literal_eval(k)
+			except ValueError:
+				return None # e.g. **other, can't tell every topic
+			try:
+				topics[key] = ast.literal_eval(v)
+			except ValueError:
+				topics[key] = None
+		return topics
+
+class PackageInfo():
+
+	def __init__(self, name, path):
+		self.name = name
+		self.path = path
+		self.classes = {} # Name in the package -> ClassInfo
+		self.files = [path] # Everything read, to tell when to parse again
+		self.stamp = None
+
+class PackageIndex():
+
+	def __init__(self):
+		self.log = logging.getLogger(self.__class__.__name__)
+		self._packages = {} # package path -> PackageInfo
+		self._listings = {} # package-path entry -> (mtime, [name, ...])
+
+	def _paths(self):
+		return list(halibot.packages.__path__)
+
+	def _stamp(self, files):
+		try:
+			return tuple(os.stat(f).st_mtime_ns for f in files)
+		except OSError:
+			return None
+
+	# Package names in one package-path entry
+	def _listdir(self, path):
+		stamp = self._stamp([path])
+		cached = self._listings.get(path)
+		if cached and cached[0] == stamp:
+			return cached[1]
+
+		names = []
+		if stamp:
+			for entry in os.listdir(path):
+				if entry.endswith(".py") and entry != "__init__.py":
+					names.append(entry[:-3])
+				elif os.path.isfile(os.path.join(path, entry, "__init__.py")):
+					names.append(entry)
+		self._listings[path] = (stamp, names)
+		return names
+
+	# Names of all the available packages
+	def names(self):
+		names = set()
+		for path in self._paths():
+			names.update(self._listdir(path))
+		return sorted(names)
+
+	# PackageInfo of the package import would find for name, None if missing
+	def get(self, name):
+		for path in self._paths():
+			if name in self._listdir(path):
+				return self._info(name, os.path.join(path, name))
+		return None
+
+	# ClassInfo of pkgname's clsname, None if it can't be found in the source
+	def find(self, pkgname, clsname):
+		info = self.get(pkgname)
+		return info.classes.get(clsname) if info else None
+
+	def _info(self, name, path):
+		info = self._packages.get(path)
+		if info and info.stamp == self._stamp(info.files):
+			return info
+
+		info = PackageInfo(name, path)
+		try:
+			self._parse(info)
+		except (OSError, SyntaxError) as e:
+			self.log.warning("Could not index package '{}': {}".format(name, e))
+			info.classes = {}
+		info.stamp = self._stamp(info.files)
+		self._packages[path] = info
+		return info
+
+	def _parse(self, info):
+		if os.path.isdir(info.path):
+			init = os.path.join(info.path, "__init__.py")
+		else:
+			init = info.path + ".py"
+			info.files = []
+		files = {}
+
+		def source(path):
+			if path not in files:
+				files[path] = SourceFile(path)
+				info.files.append(path)
+			return files[path]
+
+		def module_path(module):
+			base = os.path.join(info.path, *module.split("."))
+			return base + ".py" if os.path.isfile(base + ".py") else os.path.join(base, "__init__.py")
+
+		# Follow aliases and relative imports to the class definition
+		def lookup(src, name, depth=0):
+			if depth > 16:
+				return None
+			if name in src.classes:
+				return resolve(src, src.classes[name], depth)
+			if name in src.aliases:
+				return lookup(src, src.aliases[name], depth + 1)
+			if name in src.imports:
+				module, name = src.imports[name]
+				if module and os.path.isdir(info.path):
+					return lookup(source(module_path(module)), name, depth + 1)
+			return None
+
+		# Fill in kind, inherited attributes and whether the class is static
+		def resolve(src, ci, depth):
+			if ci.resolved:
+				return ci
+			ci.resolved = True
+
+			static = True
+			attrs = {}
+			topics = None
+			subscribe = None
+			for b in reversed(ci.bases):
+				if b in BASES:
+					ci.kind = ci.kind or BASES[b]
+					ci.commands = ci.commands or b == 'CommandModule'
+					continue
+				base = lookup(src, b, depth + 1) if b else None
+				if base is None:
+					static = False
+					continue
+				ci.kind = ci.kind or base.kind
+				ci.dynamic.update(base.dynamic)
+				static = static and base.static
+				attrs.update(base.attrs)
+				if base.topics is not None:
+					topics = base.topics
+				if base.subscribe is not None:
+					subscribe = base.subscribe
+				ci.methods.update(base.methods)
+				ci.commands = ci.commands or base.commands
+
+			attrs.update(ci.attrs)
+			ci.attrs = attrs
+			if ci.topics is None:
+				ci.topics = topics
+			if ci.subscribe is None:
+				ci.subscribe = subscribe
+			ci.static = static and not ci.dynamic
+			return ci
+
+		init_src = source(init)
+		for name in list(init_src.classes) + list(init_src.imports) + list(init_src.aliases):
+			ci = lookup(init_src, name)
+			if ci:
+				info.classes[name] = ci
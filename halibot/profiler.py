@@ -0,0 +1,152 @@
+#
+# StartupProfile
+#    Wall time spent in each phase of starting Halibot (config loading,
+#    package imports, instance construction and init), and in every module
+#    imported along the way
+#
+import contextlib
+import importlib.abc
+import json
+import sys
+import threading
+import time
+
+# Where time went for one phase or import, timed on a single thread
+class Timing():
+
+	def __init__(self, kind, name, parent):
+		self.kind = kind
+		self.name = name
+		self.parent = parent
+		self.start = time.perf_counter()
+		self.seconds = 0
+		self.children = 0 # Time spent in nested timings
+
+	def stop(self):
+		self.seconds = time.perf_counter() - self.start
+		if self.parent:
+			self.parent.children += self.seconds
+
+	def to_dict(self):
+		return {
+			"kind": self.kind,
+			"name": self.name,
+			"seconds": self.seconds,
+			"self": self.seconds - self.children,
+			"parent": self.parent.name if self.parent else None,
+		}
+
+# Loader proxy timing exec_module, put back once the module is loaded
+class TimedLoader():
+
+	def __init__(self, loader, profile):
+		self._loader = loader
+		self._profile = profile
+
+	def __getattr__(self, name):
+		return getattr(self._loader, name)
+
+	def create_module(self, spec):
+		return self._loader.create_module(spec)
+
+	def exec_module(self, module):
+		module.__loader__ = self._loader
+		if module.__spec__:
+			module.__spec__.loader = self._loader
+		with self._profile.phase("module", module.__name__):
+			self._loader.exec_module(module)
+
+# Meta path finder, asks the finders after it and wraps their loader
+class ImportTracer(importlib.abc.MetaPathFinder):
+
+	def __init__(self, profile):
+		self._profile = profile
+
+	def find_spec(self, fullname, path, target=None):
+		for finder in sys.meta_path:
+			if finder is self or not hasattr(finder, "find_spec"):
+				continue
+			spec = finder.find_spec(fullname, path, target)
+			if spec:
+				break
+		else:
+			return None
+
+		if spec.loader and hasattr(spec.loader, "exec_module"):
+			spec.loader = TimedLoader(spec.loader, self._profile)
+		return spec
+
+# Context manager doing nothing, for phases while profiling is off
+class NotTimed():
+
+	def __enter__(self):
+		return None
+
+	def __exit__(self, *exc):
+		return False
+
+NOT_TIMED = NotTimed()
+
+class StartupProfile():
+
+	def __init__(self, path=None, enabled=True):
+		self.path = path # JSON report written here by finish()
+		self.enabled = enabled
+		self.timings = []
+		self._local = threading.local()
+		self._tracer = None
+
+		if enabled:
+			self._tracer = ImportTracer(self)
+			sys.meta_path.insert(0, self._tracer)
+
+	# Time the with block as a phase of kind, e.g. ("import", "irc")
+	def phase(self, kind, name=None):
+		if not self.enabled:
+			return NOT_TIMED
+		return self._timed(kind, name)
+
+	@contextlib.contextmanager
+	def _timed(self, kind, name):
+		stack = self._local.__dict__.setdefault("stack", [])
+		t = Timing(kind, name, stack[-1] if stack else None)
+		stack.append(t)
+		try:
+			yield t
+		finally:
+			t.stop()
+			stack.pop()
+			self.timings.append(t)
+
+	# Sorted, slowest first by time not spent in nested phases
+	def report(self):
+		phases = [t.to_dict() for t in self.timings if t.kind != "module"]
+		imports = [t.to_dict() for t in self.timings if t.kind == "module"]
+		key = lambda d: d["self"]
+		return {
+			"phases": sorted(phases, key=key, reverse=True),
+			"imports": sorted(imports, key=key, reverse=True),
+		}
+
+	def table(self, limit=30):
+		report = self.report()
+		lines = []
+		for title, rows in (("Startup phases", report["phases"]), ("Imports", report["imports"][:limit])):
+			lines.append("\n{}:".format(title))
+			lines.append("  {:>9} {:>9}  {:<10} {}".format("self (s)", "total (s)", "kind", "name"))
+			for r in rows:
+				lines.append("  {:9.4f} {:9.4f}  {:<10} {}".format(r["self"], r["seconds"], r["kind"], r["name"] or ""))
+		return "\n".join(lines) + "\n"
+
+	# Stop tracing imports, and write out the report
+	def finish(self, out=None):
+		if not self.enabled:
+			return
+		if self._tracer in sys.meta_path:
+			sys.meta_path.remove(self._tracer)
+		self.enabled = False
+
+		if self.path:
+			with open(self.path, "w") as f:
+				f.write(json.dumps(self.report(), indent=4))
+		(out or sys.stdout).write(self.table())
@@ -0,0 +1,54 @@
+#
+# ReplyStore
+#    Replies to sync messages keyed by request uuid, evicted after a TTL or
+#    when the store is full, so abandoned requests can't leak
+#
+import collections
+import time
+
+class ReplyStore():
+
+	def __init__(self, ttl=60, maxsize=1024):
+		self.ttl = ttl
+		self.maxsize = maxsize
+
+		# Eviction counters
+		#  expired  - entries dropped because their TTL passed
+		#  evicted  - entries dropped to stay under maxsize
+		#  orphaned - replies dropped with those entries, never collected
+		self.stats = dict.fromkeys(('expired', 'evicted', 'orphaned'), 0)
+
+		self._entries = collections.OrderedDict() # uuid -> (deadline, [Message, ...])
+
+	def __contains__(self, uuid):
+		return uuid in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+	def _drop_oldest(self, reason):
+		_, (_, replies) = self._entries.popitem(last=False)
+		self.stats[reason] += 1
+		self.stats['orphaned'] += len(replies)
+
+	# Entries share one TTL, so the oldest entry always expires first
+	def expire(self, now=None):
+		now = time.monotonic() if now is None else now
+		while self._entries and next(iter(self._entries.values()))[0] <= now:
+			self._drop_oldest('expired')
+
+	def add(self, uuid, msg):
+		now = time.monotonic()
+		self.expire(now)
+
+		entry = self._entries.get(uuid)
+		if entry is None:
+			while len(self._entries) >= self.maxsize:
+				self._drop_oldest('evicted')
+			entry = self._entries[uuid] = (now + self.ttl, [])
+		entry[1].append(msg)
+
+	def pop(self, uuid, default=None):
+		self.expire()
+		entry = self._entries.pop(uuid, None)
+		return entry[1] if entry else default
@@ -0,0 +1,86 @@
+#
+# RouteTable
+#    Compiled (origin, destination) routes used by send_to
+#
+from .halfilter import HalFilter
+
+class Route():
+
+	def __init__(self, target, pipeline):
+		# Filter-prefixed RI, as hopped through one filter at a time
+		self.target = target
+		# ((filter, target seen by that filter), ...) to run inline before
+		#  delivering straight to the destination, None to hop instead
+		self.pipeline = pipeline
+
+# Filter lists and the routes compiled from them, swapped out as a whole so a
+#  route compiled from old filters can't end up among the new ones
+class RouteTables():
+
+	def __init__(self, inbound, outbound, generation):
+		self.inbound = inbound
+		self.outbound = outbound
+		self.generation = generation
+		self.routes = {} # (origin, instance name) -> Route
+
+class RouteTable():
+
+	def __init__(self, hal):
+		self._hal = hal
+		self._version = 0
+		self.invalidate()
+
+	# Drop every compiled route, they are rebuilt on the next lookup
+	def invalidate(self):
+		self._version += 1
+		self._tables = None
+
+	def build(self):
+		version = self._version
+		generation = self._hal.config.generation
+		fl = self._hal.config.get("filters") or {}
+		t = RouteTables(fl.get("inbound", {}), fl.get("outbound", {}), generation)
+
+		# Not kept if invalidated while building, the next lookup builds again
+		if version == self._version:
+			self._tables = t
+		return t
+
+	# Filters that override receive rely on being hopped through
+	def _fusable(self, obj):
+		return isinstance(obj, HalFilter) and type(obj).receive is HalFilter.receive
+
+	# Compiled once per instance name, the rest of the RI is added by resolve
+	def _compile(self, t, origin, name):
+		chain = t.outbound.get(origin, []) + t.inbound.get(name, [])
+		if not chain:
+			return Route(name, ())
+
+		filters = [self._hal.objects.get(f) for f in chain]
+		pipeline = None
+		if all(self._fusable(f) for f in filters):
+			pipeline = tuple((f, "/".join(chain[i+1:] + [name])) for i, f in enumerate(filters))
+
+		return Route("/".join(chain + [name]), pipeline)
+
+	# Return the Route a message from origin to dest takes
+	def resolve(self, origin, dest):
+		t = self._tables
+		if t is None or t.generation != self._hal.config.generation:
+			t = self.build()
+
+		name, sep, rest = dest.partition("/")
+		key = (origin, name)
+		route = t.routes.get(key)
+		if route is None:
+			# Cached in the tables it was compiled from, dropped with them
+			route = t.routes[key] = self._compile(t, origin, name)
+		if not sep:
+			return route
+
+		# Per-user part of the RI (e.g. irc/#channel), not worth caching
+		rest = sep + rest
+		pipeline = route.pipeline
+		if pipeline:
+			pipeline = tuple((f, target + rest) for f, target in pipeline)
+		return Route(route.target + rest, pipeline)
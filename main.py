@@ -61,7 +61,11 @@ def h_run(args):
 		print("Failed to start: No halibot configuration found in the current directory!")
 		return
 
-	bot = halibot.Halibot()
+	profile = None
+	if args.profile_startup:
+		profile = halibot.StartupProfile(path=args.profile_startup)
+
+	bot = halibot.Halibot(profile=profile)
 	bot._load_config()
 
 	logfile = None
@@ -202,6 +206,11 @@ def h_info(args):
 	bot = halibot.Halibot()
 	bot._load_config()
 
+	# Version of a class, as found in the package source
+	def describe(of):
+		cls = bot.package_index.find(*of.split(":", 1)) if ":" in of else None
+		return " " + cls.version if cls and cls.version else ""
+
 	if args.object_name:
 		# Show configuration of specific object
 
@@ -211,23 +220,23 @@ def h_info(args):
 			print("No such agent or module")
 			return
 
-		print("\n{args.object_name}: ({conf['of']})".format(args=args, conf=conf))
+		print("\n{}: ({}{})".format(args.object_name, conf["of"], describe(conf["of"])))
 		for k in conf:
 			if k != "of":
-				print("  {k}: {conf[k]}".format(k=k, conf=conf))
+				print("  {}: {}".format(k, conf[k]))
 	else:
 		# Show all configured objects
 		if len(bot.config.get("agent-instances", {})) > 0:
 			print("\nConfigured agents:")
 			agents = bot.config.get("agent-instances")
 			for name in agents:
-				print("  {name} ({agents[name]['of']})".format(name=name, agents=agents))
+				print("  {} ({}{})".format(name, agents[name]["of"], describe(agents[name]["of"])))
 
 		if len(bot.config.get("module-instances", {})) > 0:
 			print("\nConfigured modules:")
 			modules = bot.config.get("module-instances")
 			for name in modules:
-				print("  {name} ({modules[name]['of']})".format(name=name, modules=modules))
+				print("  {} ({}{})".format(name, modules[name]["of"], describe(modules[name]["of"])))
 
 	print("")
 
@@ -236,14 +245,14 @@ def h_list_packages(args):
 	bot = halibot.Halibot()
 	bot._load_config()
 
-	pkgs = []
-	for path in bot.config.get("package-path"):
-		pkgs = pkgs + os.listdir(path)
-	pkgs.sort()
-
+	# Read from the package source, without importing anything
 	print("\nAvailable packages:")
-	for p in pkgs:
+	for p in bot.package_index.names():
 		print("  {}".format(p))
+		for name, cls in bot.package_index.get(p).classes.items():
+			if name == cls.name and cls.kind:
+				version = " " + cls.version if cls.version else ""
+				print("    {} ({}{})".format(name, cls.kind, version))
 	print("")
 
 def h_add(args):
@@ -422,6 +431,7 @@ if __name__ == "__main__":
 	run.add_argument("-i", "--interactive", help="enter a python shell after starting halibot", action="store_true", required=False)
 	run.add_argument("-f", "--log-file", help="file to output logs to, none by default")
 	run.add_argument("-l", "--log-level", help="level of logs, DEBUG by default")
+	run.add_argument("-p", "--profile-startup", help="time each phase of startup and every import, writing a JSON report to the given file (startup-profile.json by default) and a table to stdout", nargs="?", const="startup-profile.json", metavar="FILE")
 
 	fetch = sub.add_parser("fetch", help="fetch remote packages")
 	fetch.add_argument("packages", help="name of package to fetch", nargs="+", metavar="package")
@@ -22,9 +22,9 @@ class Admin(CommandModule):
 		self._hal.shutdown()
 
 	@hasPermission("ADMIN", reply=True, permissive=False)
-	def cmd_reload(self, args, msg=None):
+	async def cmd_reload(self, args, msg=None):
 		try:
-			self._hal.reload(args)
+			await self._hal.async_reload(args)
 		except Exception as e:
 			self.reply(msg, body=f"Could not reload '{args}': {e}")
 		else:
@@ -1,7 +1,7 @@
 #
 # HelpModule
 #
-from halibot import CommandModule, Message
+from halibot import CommandModule, HalObject, Message
 
 class Help(CommandModule):
 
@@ -10,10 +10,68 @@ class Help(CommandModule):
 			'help' : self.command
 		}
 
-	def general_help(self, target):
-		hmsg = Message(body=[], type='help', origin=self.name)
-		replies = self.sync_send_to(hmsg, target)
+		# Topic -> [RI, ...] of everything answering to it, rebuilt whenever
+		#  the loaded objects change
+		self._topics = None
+		self._text = None
+		self._generation = None
 
+		# Seconds to wait for answers, and consecutive misses before warning
+		self.timeout = self.config.get('timeout', 5)
+		self.miss_warn = self.config.get('miss-warn', 3)
+		self.misses = {} # RI -> consecutive deadlines missed
+
+	# Objects whose topics can be read directly instead of asking for them
+	def _local_topics(self, ri):
+		o = self._hal.objects.get(ri)
+		if o and type(o)._receivers.get('help') is HalObject.receive_help:
+			return list(getattr(o, 'topics', {}).keys())
+		return None
+
+	async def topic_index(self, target):
+		gen = self._hal.objects.generation
+		if self._topics is not None and gen == self._generation:
+			return self._topics
+
+		found = { ri: self._local_topics(ri) for ri in target }
+
+		# Only objects with their own receive_help need to be asked
+		remote = [ri for ri, t in found.items() if t is None]
+		if remote:
+			hmsg = Message(body=[], type='help', origin=self.name)
+			gather = self.scatter(hmsg, remote)
+			replies = await gather.wait(self.timeout)
+			for ri, r in replies.items():
+				found[ri] = r[0].body
+			# Don't keep an index that is missing a slow module's topics
+			complete = self._missed(gather)
+		else:
+			complete = True
+
+		topics = {}
+		for ri, ts in found.items():
+			for t in ts or []:
+				topics.setdefault(t, []).append(ri)
+
+		self._topics = topics
+		self._text = self.format_help(topics.keys())
+		self._generation = gen if complete else None
+		return topics
+
+	# Count the targets of gather still pending at the deadline, returns
+	#  whether everyone answered
+	def _missed(self, gather):
+		pending = gather.pending
+		for ri in gather.futs:
+			if ri not in pending:
+				self.misses.pop(ri, None)
+				continue
+			n = self.misses[ri] = self.misses.get(ri, 0) + 1
+			if n % self.miss_warn == 0:
+				self.log.warning("'{}' missed the help deadline {} times in a row".format(ri, n))
+		return not pending
+
+	def format_help(self, topics):
 		text = '''The help command gives useful help messages.
 
 Syntax:
@@ -21,11 +79,6 @@ Syntax:
 
 Available topics:
 '''
-		# Collect the available topics
-		topics = []
-		for r in replies.values():
-			topics += [t for t in r[0].body if not t in topics]
-
 		# Append the available topics to the list
 		c = 2
 		line = '  '
@@ -53,7 +106,11 @@ Available topics:
 
 		return text
 
-	def command(self, args, msg=None):
+	async def general_help(self, target):
+		await self.topic_index(target)
+		return self._text
+
+	async def command(self, args, msg=None):
 		# TODO When containers/routes become more integrated, just look at the
 		#      container the message was sent to, which shoudl work for the
 		#      default container as well.
@@ -61,11 +118,20 @@ Available topics:
 		target = [t for t in target if t.split('/')[0] != self.name] # Can't sync send to this module
 
 		if args == '':
-			self.reply(msg, body=self.general_help(target))
+			self.reply(msg, body=await self.general_help(target))
 		else:
-			hmsg = Message(body=args.split(' '), type='help', origin=self.name)
-			replies = self.sync_send_to(hmsg, target)
+			body = args.split(' ')
+			key = '/'.join(body)
+			# Skip objects known not to have the topic, None means ask
+			local = { ri: self._local_topics(ri) for ri in target }
+			target = [ri for ri in target if local[ri] is None or key in local[ri]]
+
+			# First non-empty answer wins
+			hmsg = Message(body=body, type='help', origin=self.name)
+			gather = self.scatter(hmsg, target)
+			replies = await gather.first(self.timeout)
+			if not replies:
+				self._missed(gather)
 
 			if len(replies) > 0:
-				# TODO check for discrepancies among replies
 				self.reply(msg, body=list(replies.values())[0][0].body)
@@ -20,6 +20,10 @@ class Hello(HalModule):
 	VERSION = "1.0.0"
 	HAL_MINIMUM = "0.1"
 
+	# Only messages starting with "!hello" are dispatched to this module by
+	#  agents, so it does not need to look at every other message
+	subscribe = { 'types': ['simple'], 'prefixes': ['!hello'] }
+
 	# Called when the module is initialized
 	#  Put any initialization logic here, instead of __init__()
 	#  In this case, no initialization is needed, thus it is a no-op
@@ -5,6 +5,11 @@ import util
 import halibot
 import unittest
 import os
+import json
+import shutil
+import tempfile
+import re
+import concurrent.futures
 
 class StubModuleFunc(halibot.HalModule):
 
@@ -215,6 +220,56 @@ class TestAuth(util.HalibotTestCase):
 		stub.receive(msg)
 		self.assertTrue(stub.called)
 
+	def test_hasperm_index(self):
+		auth = self.bot.auth
+		auth.enabled = True
+		auth.perms = [
+			("irc/#chan", "alice", "Foo"),
+			("irc/.*", "*", "Bar"),
+			("xmpp", "bob", "Baz|Qux"),
+			("cli", "*", ""),
+		]
+
+		# Same semantics as re.match on every rule
+		def reference(ri, identity, perm):
+			for a,b,c in auth.perms:
+				if re.match(a, ri) and b in (identity, "*") and re.match(c, perm):
+					return True
+			return False
+
+		for ri in ("irc/#chan", "irc/#chan2", "irc/#other", "xmpp/room", "cli", "nope"):
+			for identity in ("alice", "bob", "*", ""):
+				for perm in ("Foo", "FooBar", "Bar", "Baz", "Qux", "Nope"):
+					self.assertEqual(auth.hasPermission(ri, identity, perm), bool(reference(ri, identity, perm)), (ri, identity, perm))
+
+		# Literal rules still match as a prefix, like re.match does
+		self.assertTrue(auth.hasPermission("irc/#chan2", "alice", "FooBar"))
+		self.assertFalse(auth.hasPermission("irc/#chan", "bob", "Foo"))
+
+		auth.revokePermission("irc/.*", "*", "Bar")
+		self.assertFalse(auth.hasPermission("irc/#chan", "bob", "Bar"))
+
+	def test_decision_cache(self):
+		auth = halibot.halauth.HalAuth(cache_size=2)
+		auth.enabled = True
+		auth.perms = [("foo", "bar", "baz")]
+
+		self.assertTrue(auth.hasPermission("foo", "bar", "baz"))
+		self.assertTrue(auth.hasPermission("foo", "bar", "baz"))
+		self.assertEqual(auth.decisions.stats, { 'hits': 1, 'misses': 1 })
+
+		auth.hasPermission("foo", "bar", "nope")
+		auth.hasPermission("foo", "qux", "baz")
+		self.assertEqual(len(auth.decisions), 2)
+
+		# Every change to the rules invalidates cached decisions
+		auth.revokePermission("foo", "bar", "baz")
+		self.assertFalse(auth.hasPermission("foo", "bar", "baz"))
+		auth.grantPermission("foo", "bar", "baz")
+		self.assertTrue(auth.hasPermission("foo", "bar", "baz"))
+		auth.perms = []
+		self.assertFalse(auth.hasPermission("foo", "bar", "baz"))
+
 	def test_load_perms(self):
 		# A bad JSON string should give the user no permissions
 		with open("testperms.json", "w") as f:
@@ -235,6 +290,101 @@ class TestAuth(util.HalibotTestCase):
 		self.bot.auth.load_perms("testperms.json")
 		self.assertTrue(self.bot.auth.enabled)
 
+	def test_journal(self):
+		path = os.path.join(tempfile.mkdtemp(prefix='halibot-test'), "perms.json")
+		with open(path, "w") as f:
+			f.write('[["foo", "bar", "baz"]]')
+
+		auth = halibot.halauth.HalAuth()
+		auth.load_perms(path)
+		auth.grantPermission("a", "b", "c")
+		auth.grantPermission("d", "e", "f")
+		auth.revokePermission("foo", "bar", "baz")
+
+		# Changes are appended to the journal, the file itself is untouched
+		with open(path + ".journal") as f:
+			self.assertEqual(len(f.readlines()), 3)
+		with open(path) as f:
+			self.assertEqual(json.load(f), [["foo", "bar", "baz"]])
+
+		# Loading replays the journal and compacts it into the file
+		other = halibot.halauth.HalAuth()
+		other.load_perms(path)
+		self.assertEqual(other.perms, [("a", "b", "c"), ("d", "e", "f")])
+		self.assertFalse(os.path.exists(path + ".journal"))
+		with open(path) as f:
+			self.assertEqual(json.load(f), [["a", "b", "c"], ["d", "e", "f"]])
+
+		# Compacted periodically...
+		other.COMPACT_EVERY = 2
+		other.grantPermission("g", "h", "i")
+		self.assertTrue(os.path.exists(path + ".journal"))
+		other.grantPermission("j", "k", "l")
+		self.assertFalse(os.path.exists(path + ".journal"))
+
+		# ...and at shutdown
+		bot = halibot.Halibot(use_config=False)
+		bot.start(block=False)
+		bot.auth.load_perms(path)
+		bot.auth.grantPermission("m", "n", "o")
+		bot.shutdown()
+		self.assertFalse(os.path.exists(path + ".journal"))
+		with open(path) as f:
+			self.assertEqual(json.load(f), [["a", "b", "c"], ["d", "e", "f"], ["g", "h", "i"], ["j", "k", "l"], ["m", "n", "o"]])
+
+		shutil.rmtree(os.path.dirname(path))
+
+	def test_watch(self):
+		path = os.path.join(tempfile.mkdtemp(prefix='halibot-test'), "perms.json")
+		with open(path, "w") as f:
+			f.write('[]')
+
+		auth = self.bot.auth
+		auth.load_perms(path)
+		auth.watch(self.bot.eventloop, 0.05)
+		self.assertFalse(auth.hasPermission("foo", "bar", "baz"))
+
+		# Edited out of band
+		with open(path, "w") as f:
+			f.write('[["foo", "bar", "baz"]]')
+		util.waitOrTimeout(100, lambda: auth.hasPermission("foo", "bar", "baz"))
+		self.assertTrue(auth.hasPermission("foo", "bar", "baz"))
+
+		# A broken edit keeps the current rules
+		with open(path, "w") as f:
+			f.write('[["foo", "bar"')
+		time.sleep(0.5)
+		self.assertTrue(auth.hasPermission("foo", "bar", "baz"))
+
+		auth.unwatch()
+		shutil.rmtree(os.path.dirname(path))
+
+	def test_reload_keeps_grants(self):
+		path = os.path.join(tempfile.mkdtemp(prefix='halibot-test'), "perms.json")
+		self.addCleanup(shutil.rmtree, os.path.dirname(path))
+		with open(path, "w") as f:
+			f.write('[["foo", "bar", "baz"]]')
+
+		auth = halibot.halauth.HalAuth()
+		auth.load_perms(path)
+
+		# Changes replace the index rather than changing it under a check
+		rules = auth._rules
+		auth.grantPermission("a", "b", "c")
+		self.assertIsNot(auth._rules, rules)
+		self.assertNotIn(("a", "b", "c"), rules)
+
+		# A reload parsed before a grant and revoke doesn't undo them
+		auth._reloading = True
+		auth._since_reload = []
+		parsed = auth._compile(halibot.halauth.read_perms(path)[0] + [("x", "y", "z")])
+		auth.grantPermission("d", "e", "f")
+		auth.revokePermission("foo", "bar", "baz")
+		fut = concurrent.futures.Future()
+		fut.set_result(parsed)
+		auth._reloaded(fut)
+		self.assertEqual(set(auth.perms), { ("a", "b", "c"), ("d", "e", "f"), ("x", "y", "z") })
+
 	def test_write_perms(self):
 		self.bot.auth.enabled = True
 		self.bot.auth.path = "testperms.json"
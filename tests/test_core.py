@@ -4,7 +4,16 @@ import time
 import util
 import halibot
 import unittest
+import unittest.mock
 import threading
+import asyncio
+import concurrent.futures
+import json
+import sys
+import os
+import shutil
+import socket
+import tempfile
 
 topic1_text = 'Help text one'
 topic2_text = 'Help text two'
@@ -109,6 +118,36 @@ class TestCore(util.HalibotTestCase):
 		self.assertEqual(stub, self.bot.objects.agents.get('stub_agent'))
 		self.assertEqual(len(self.bot.objects.modules.keys()), 0)
 
+	def test_object_indexes(self):
+		objects = self.bot.objects
+		mod = StubModule(self.bot)
+		agent = StubAgent(self.bot)
+		gen = objects.generation
+
+		self.bot.add_instance('stub', mod)
+		self.assertEqual(dict(objects.modules), { 'stub': mod })
+
+		# Replacing an object moves it between indexes
+		self.bot.add_instance('stub', agent)
+		self.assertEqual(dict(objects.modules), {})
+		self.assertEqual(dict(objects.agents), { 'stub': agent })
+
+		objects.pop('stub')
+		self.assertEqual(len(objects.agents), 0)
+		self.assertGreater(objects.generation, gen)
+
+		# popitem takes the last object out of its index too
+		objects['a'] = mod
+		objects['b'] = agent
+		self.assertEqual(objects.popitem(), ('b', agent))
+		self.assertEqual(len(objects.agents), 0)
+		objects.popitem()
+		with self.assertRaises(KeyError):
+			objects.popitem()
+
+		with self.assertRaises(TypeError):
+			objects.modules['foo'] = mod
+
 	def test_send_recv(self):
 		agent = StubAgent(self.bot)
 		mod = StubModule(self.bot)
@@ -177,6 +216,30 @@ class TestCore(util.HalibotTestCase):
 		self.assertEqual(qua2.body, mod2.received_mytype[0].body)
 
 
+	def test_fanout_misc(self):
+		class MiscModule(halibot.HalModule):
+			def init(self):
+				self.received = []
+			def receive(self, msg):
+				msg.misc[self.name] = True
+				self.received.append(msg)
+
+		agent = StubAgent(self.bot)
+		mod = MiscModule(self.bot)
+		mod2 = MiscModule(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_mod', mod)
+		self.bot.add_instance('stub_mod2', mod2)
+
+		msg = halibot.Message(body='foo', misc={ 'agent': True })
+		agent.send_to(msg, ['stub_mod', 'stub_mod2'])
+		util.waitOrTimeout(100, lambda: len(mod.received) == 1 and len(mod2.received) == 1)
+
+		# Changes to misc don't leak between recipients
+		self.assertEqual(mod.received[0].misc, { 'agent': True, 'stub_mod': True })
+		self.assertEqual(mod2.received[0].misc, { 'agent': True, 'stub_mod2': True })
+		self.assertEqual(msg.misc, { 'agent': True })
+
 	def test_send_reply(self):
 		agent = StubAgent(self.bot)
 		mod = StubReplier(self.bot)
@@ -196,6 +259,116 @@ class TestCore(util.HalibotTestCase):
 		self.assertEqual(len(agent.received), 1)
 		self.assertEqual(agent.received[0].body, "foobar")
 
+	def test_receivers_table(self):
+		self.assertEqual(StubModule._receivers['mytype'], StubModule.receive_mytype)
+		self.assertEqual(StubModule._receivers['help'], halibot.HalObject.receive_help)
+		self.assertNotIn('mytype', StubReplier._receivers)
+
+		# A redefined class (e.g. after reload) gets its own table
+		class StubModule2(StubModule):
+			def receive_other(self, msg):
+				pass
+		self.assertIn('other', StubModule2._receivers)
+		self.assertIn('mytype', StubModule2._receivers)
+		self.assertNotIn('other', StubModule._receivers)
+
+	def test_receivers_static_and_instance(self):
+		class Handlers(halibot.HalModule):
+			def init(self):
+				self.got = []
+				self.receive_mine = lambda msg: self.got.append(('mine', msg.body))
+
+			@staticmethod
+			def receive_static(msg):
+				Handlers.static.append(msg.body)
+
+			def receive(self, msg):
+				self.got.append(('generic', msg.body))
+		Handlers.static = []
+
+		mod = Handlers(self.bot)
+		self.bot.add_instance('stub_handlers', mod)
+		mod._dispatch(halibot.Message(body='a', type='mine'))
+		mod._dispatch(halibot.Message(body='b', type='static'))
+		mod._dispatch(halibot.Message(body='c', type='other'))
+		self.assertEqual(mod.got, [('mine', 'a'), ('generic', 'c')])
+		self.assertEqual(Handlers.static, ['b'])
+
+	def test_same_loop_send(self):
+		class RelayModule(halibot.HalModule):
+			def receive(self, msg):
+				self.queued = self.send_to(halibot.Message(body=msg.body), ['stub_module'])
+
+		agent = StubAgent(self.bot)
+		relay = RelayModule(self.bot)
+		mod = StubModule(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_relay', relay)
+		self.bot.add_instance('stub_module', mod)
+
+		# Record which threads hop onto the loop
+		loop = self.bot.eventloop
+		threadsafe = loop.call_soon_threadsafe
+		hops = []
+		def record(*args, **kwargs):
+			hops.append('loop' if asyncio._get_running_loop() is loop else 'thread')
+			return threadsafe(*args, **kwargs)
+
+		with unittest.mock.patch.object(loop, 'call_soon_threadsafe', record):
+			agent.send_to(halibot.Message(body='foo'), ['stub_relay'])
+			util.waitOrTimeout(100, lambda: len(mod.received) != 0)
+
+		self.assertEqual(len(mod.received), 1)
+		self.assertEqual(mod.received[0].origin, 'stub_relay')
+
+		# Only the agent's send took the threadsafe hop, the relay's send on
+		#  the loop was scheduled directly
+		self.assertEqual(hops, ['thread'])
+
+	def test_async_receive(self):
+		class AsyncReplier(halibot.HalModule):
+			def init(self):
+				self.received = []
+
+			async def receive(self, msg):
+				self.received.append(msg)
+				await asyncio.sleep(0.5)
+				await self.async_reply(msg, body=msg.body + "bar")
+
+		class AsyncCommand(halibot.CommandModule):
+			def init(self):
+				self.commands = { "foo": self.foo }
+
+			@halibot.AsArgs
+			async def foo(self, args, msg=None):
+				await asyncio.sleep(0)
+				self.reply(msg, body="fooed " + str(len(args)))
+
+		agent = StubAgent(self.bot)
+		mod = AsyncReplier(self.bot)
+		cmd = AsyncCommand(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_module', mod)
+		self.bot.add_instance('stub_cmodule', cmd)
+
+		# Handlers sleep concurrently on the loop rather than one after another
+		start = time.time()
+		for i in range(10):
+			agent.send_to(halibot.Message(body=str(i)), ['stub_module'])
+		util.waitOrTimeout(100, lambda: len(agent.received) == 10)
+		self.assertEqual(len(agent.received), 10)
+		self.assertLess(time.time() - start, 2)
+		self.assertEqual(set(m.body for m in agent.received), set(str(i) + "bar" for i in range(10)))
+
+		agent.received = []
+		agent.send_to(halibot.Message(body='!foo a b'), ['stub_cmodule'])
+		util.waitOrTimeout(100, lambda: len(agent.received) == 1)
+		self.assertEqual(agent.received[0].body, "fooed 2")
+
+		# Sync senders wait for the coroutine to finish
+		rep = agent.sync_send_to(halibot.Message(body='baz'), ['stub_module'])
+		self.assertEqual(rep['stub_module'][0].body, 'bazbar')
+
 	def test_sync_send(self):
 		agent = StubAgent(self.bot)
 		mod = StubReplier(self.bot)
@@ -210,6 +383,44 @@ class TestCore(util.HalibotTestCase):
 		with self.assertRaises(halibot.SyncSendSelfException):
 			agent.sync_send_to(foo, ['stub_agent'])
 
+	def test_request(self):
+		class SlowReplier(halibot.HalModule):
+			async def receive(self, msg):
+				self.reply(msg, body="early")
+				await asyncio.sleep(5)
+				self.reply(msg, body="late")
+
+		class Requester(halibot.HalModule):
+			def init(self):
+				self.result = None
+				self.error = None
+
+			async def receive(self, msg):
+				try:
+					self.sync_send_to(halibot.Message(body='foo'), ['stub_fast'])
+				except halibot.SyncSendLoopException as e:
+					self.error = e
+				gather = self.scatter(halibot.Message(body='foo'), ['stub_fast', 'stub_slow'])
+				self.result = await gather.wait(timeout=0.5)
+				self.pending = gather.pending
+
+		req = Requester(self.bot)
+		self.bot.add_instance('stub_requester', req)
+		self.bot.add_instance('stub_fast', StubReplier(self.bot))
+		self.bot.add_instance('stub_slow', SlowReplier(self.bot))
+
+		agent = StubAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		agent.send_to(halibot.Message(body='go'), ['stub_requester'])
+
+		util.waitOrTimeout(100, lambda: req.result != None)
+
+		# The deadline passed, so the slow target's reply is partial
+		self.assertIsInstance(req.error, halibot.SyncSendLoopException)
+		self.assertEqual([m.body for m in req.result['stub_fast']], ['foobar'])
+		self.assertEqual([m.body for m in req.result['stub_slow']], ['early'])
+		self.assertEqual(req.pending, ['stub_slow'])
+
 	def test_help(self):
 		agent = StubAgent(self.bot)
 		mod = StubModule(self.bot)
@@ -337,6 +548,75 @@ class TestCore(util.HalibotTestCase):
 
 		self.assertEqual(0, len(agent.received))
 
+	def test_command_dispatch(self):
+		class StubNamespace(StubCommand):
+			def init(self):
+				super().init()
+				self.namespace = "ns"
+
+		mod = StubCommand(self.bot)
+		ns = StubNamespace(self.bot)
+		raw = StubModule(self.bot)
+		agent = StubAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_cmodule', mod)
+		self.bot.add_instance('stub_ns', ns)
+		self.bot.add_instance('stub_raw', raw)
+
+		index = self.bot.dispatch_index
+		self.assertEqual(index.route(halibot.Message(body='hello')), ['stub_raw'])
+		self.assertEqual(index.route(halibot.Message(body='!foo bar')), ['stub_cmodule', 'stub_raw'])
+		self.assertEqual(index.route(halibot.Message(body='!ns foo')), ['stub_ns', 'stub_raw'])
+		self.assertEqual(index.route(halibot.Message(body='!nope')), ['stub_raw'])
+		self.assertEqual(index.route(halibot.Message(body=[], type='help')), ['stub_cmodule', 'stub_ns', 'stub_raw'])
+
+		# Rebuilding leaves the tables a concurrent route() may be reading alone
+		tables = index._tables
+		modules = list(tables.modules)
+		index.invalidate()
+		self.assertIsNot(index.build(), tables)
+		self.assertEqual(tables.modules, modules)
+		self.assertIsNot(index._tables, tables)
+
+		agent.dispatch(halibot.Message(body='hello'))
+		agent.dispatch(halibot.Message(body='!foo moo'))
+		util.waitOrTimeout(100, lambda: len(raw.received) == 2 and len(agent.received) == 1)
+
+		# Only the command was queued to the command module
+		self.assertEqual(mod.inbox.stats['accepted'], 1)
+		self.assertEqual(ns.inbox.stats['accepted'], 0)
+		self.assertEqual(mod.foo_args, ['moo'])
+		self.assertEqual(agent.received[0].body, 'fooed moo')
+
+	def test_subscriptions(self):
+		class HelloModule(StubModule):
+			subscribe = { 'types': ['simple'], 'prefixes': ['!hello', '!hi'] }
+
+		hello = HelloModule(self.bot)
+		pattern = StubModule(self.bot, conf={ 'subscribe': { 'patterns': ['wor?ld'] } })
+		typed = StubModule(self.bot, conf={ 'subscribe': { 'types': ['mytype'] } })
+		raw = StubModule(self.bot)
+		agent = StubAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_hello', hello)
+		self.bot.add_instance('stub_pattern', pattern)
+		self.bot.add_instance('stub_typed', typed)
+		self.bot.add_instance('stub_raw', raw)
+
+		route = lambda **kw: self.bot.dispatch_index.route(halibot.Message(**kw))
+		self.assertEqual(route(body='foo'), ['stub_raw'])
+		self.assertEqual(route(body='!hello world'), ['stub_hello', 'stub_pattern', 'stub_raw'])
+		self.assertEqual(route(body='!hi'), ['stub_hello', 'stub_raw'])
+		self.assertEqual(route(body='!hello', type='mytype'), ['stub_typed', 'stub_raw'])
+		self.assertEqual(route(body=['wold'], type='mytype'), ['stub_typed', 'stub_raw'])
+
+		agent.dispatch(halibot.Message(body='foo'))
+		agent.dispatch(halibot.Message(body='!hi'))
+		util.waitOrTimeout(100, lambda: len(raw.received) == 2)
+		self.assertEqual(len(raw.received), 2)
+		self.assertEqual([m.body for m in hello.received], ['!hi'])
+		self.assertEqual(pattern.inbox.stats['accepted'], 0)
+
 	def test_restart(self):
 		mod = StubModule(self.bot)
 		mod2 = StubModule(self.bot)
@@ -414,6 +694,294 @@ class TestCore(util.HalibotTestCase):
 		self.assertEqual(3, len(mod.received))
 		self.assertEqual("foo", mod.received[2].body)
 
+	def test_reload_config(self):
+		workdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, workdir)
+		path = os.path.join(workdir, 'config.json')
+		bot = halibot.Halibot(use_config=False, workdir=workdir)
+
+		def write(instances):
+			with open(path, 'w') as f:
+				f.write(json.dumps({ 'package-path': ['${HALDIR}/packages'], 'module-instances': instances }))
+
+		write({ 'a': { 'of': 'hello:Hello' }, 'b': { 'of': 'hello:Hello' }, 'c': { 'of': 'hello:Hello' } })
+		bot.reload_config()
+		self.assertEqual(set(bot.objects.modules.keys()), { 'a', 'b', 'c' })
+		a, b = bot.objects['a'], bot.objects['b']
+
+		write({ 'a': { 'of': 'hello:Hello' }, 'b': { 'of': 'hello:Hello', 'x': 1 }, 'd': { 'of': 'hello:Hello' } })
+		changes = bot.reload_config()
+		self.assertEqual(changes, { 'added': ['d'], 'removed': ['c'], 'restarted': ['b'], 'failed': [] })
+		self.assertEqual(set(bot.objects.modules.keys()), { 'a', 'b', 'd' })
+		self.assertIs(bot.objects['a'], a)
+		self.assertIsNot(bot.objects['b'], b)
+		self.assertEqual(bot.objects['b'].config['x'], 1)
+
+		# Objects changing their own config don't count as a change
+		bot.objects['a'].config['out'] = ['somewhere']
+		self.assertEqual(bot.reload_config(), { 'added': [], 'removed': [], 'restarted': [], 'failed': [] })
+
+		# Instances that fail to start don't hold up the others, and are tried
+		#  again on the next change
+		good = { 'a': { 'of': 'hello:Hello' }, 'b': { 'of': 'hello:Hello', 'x': 1 }, 'd': { 'of': 'hello:Hello' }, 'g': { 'of': 'hello:Hello' } }
+		write(dict(good, f={ 'of': 'hello:Hello', 'inbox-policy': 'bogus' }))
+		changes = bot.reload_config()
+		self.assertEqual((sorted(changes['added']), changes['failed']), (['f', 'g'], ['f']))
+		self.assertEqual(set(bot.objects.modules.keys()), { 'a', 'b', 'd', 'g' })
+
+		write(dict(good, f={ 'of': 'hello:Hello', 'inbox-policy': 'block' }))
+		changes = bot.reload_config()
+		self.assertEqual((changes['added'], changes['failed']), (['f'], []))
+		self.assertEqual(set(bot.objects.modules.keys()), { 'a', 'b', 'd', 'f', 'g' })
+
+		# A running instance whose new config doesn't construct keeps running
+		a = bot.objects['a']
+		write(dict(good, f={ 'of': 'hello:Hello', 'inbox-policy': 'block' }, a={ 'of': 'hello:Hello', 'inbox-policy': 'bogus' }))
+		changes = bot.reload_config()
+		self.assertEqual((changes['restarted'], changes['failed']), (['a'], ['a']))
+		self.assertIs(bot.objects['a'], a)
+
+		# Errors while reloading in the background are logged
+		fut = concurrent.futures.Future()
+		fut.set_exception(ValueError('boom'))
+		with self.assertLogs(bot.log, 'ERROR'):
+			bot._config_reloaded(fut)
+
+		# A broken config leaves everything running
+		with open(path, 'w') as f:
+			f.write('{')
+		self.assertIsNone(bot.reload_config())
+		self.assertEqual(set(bot.objects.modules.keys()), { 'a', 'b', 'd', 'f', 'g' })
+
+		# Changes are picked up while running
+		write({ 'e': { 'of': 'hello:Hello' } })
+		self.bot.workdir = workdir
+		self.bot.watch_config(0.1)
+		util.waitOrTimeout(100, lambda: 'e' in self.bot.objects)
+		self.assertIn('e', self.bot.objects.modules)
+
+	def test_start_instances(self):
+		pkgdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, pkgdir)
+		os.mkdir(os.path.join(pkgdir, 'startstub'))
+		with open(os.path.join(pkgdir, 'startstub', '__init__.py'), 'w') as f:
+			f.write(
+				'import time, halibot\n'
+				'events = {}\n'
+				'class Slow(halibot.HalModule):\n'
+				'\tHAL_MINIMUM = "0.2.0"\n'
+				'\tdef init(self):\n'
+				'\t\tstart = time.monotonic()\n'
+				'\t\ttime.sleep(self.config.get("sleep", 0))\n'
+				'\t\tevents[self.name] = (start, time.monotonic())\n'
+				'\t\tself.seen = []\n'
+				'\tdef receive(self, msg):\n'
+				'\t\tself.seen.append(msg.body)\n'
+			)
+		self.bot.config.set_local({ 'package-path': [pkgdir] })
+
+		started = self.bot.start_instances({
+			'a': { 'of': 'startstub:Slow', 'sleep': 0.3 },
+			'b': { 'of': 'startstub:Slow', 'depends-on': 'a' },
+			'c': { 'of': 'startstub:Slow', 'sleep': 0.3 },
+			'd': { 'of': 'startstub:Slow', 'depends-on': ['e'] },
+			'e': { 'of': 'startstub:Slow', 'depends-on': ['d'] },
+			'f': { 'of': 'startstub:Slow', 'inbox-policy': 'bogus' },
+		})
+		events = self.bot.get_package('startstub').events
+
+		# Registered in config order, leaving out the dependency cycle and the
+		#  instance failing to construct
+		self.assertEqual(started, ['a', 'b', 'c'])
+		self.assertEqual(list(self.bot.objects.keys()), ['a', 'b', 'c'])
+
+		# a and c start together, b waits for a
+		self.assertLess(events['c'][0], events['a'][1])
+		self.assertGreaterEqual(events['b'][0], events['a'][1])
+
+		# Messages arriving before init() returned are held, not lost
+		agent = StubAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		starter = threading.Thread(target=self.bot.start_instances, args=({ 'g': { 'of': 'startstub:Slow', 'sleep': 0.3 } },))
+		starter.start()
+		util.waitOrTimeout(100, lambda: 'g' in self.bot.objects)
+		agent.send_to(halibot.Message(body='early'), ['g'])
+		starter.join()
+		util.waitOrTimeout(100, lambda: len(self.bot.objects['g'].seen) == 1)
+		self.assertEqual(self.bot.objects['g'].seen, ['early'])
+
+	def test_lazy_instance(self):
+		pkgdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, pkgdir)
+		os.mkdir(os.path.join(pkgdir, 'lazystub'))
+		with open(os.path.join(pkgdir, 'lazystub', '__init__.py'), 'w') as f:
+			f.write(
+				'import halibot\n'
+				'class Echo(halibot.HalModule):\n'
+				'\tHAL_MINIMUM = "0.2.0"\n'
+				'\ttopics = { "echo": "Says it back", "when": lambda: "Now" }\n'
+				'\tdef receive(self, msg):\n'
+				'\t\tself.reply(msg, body=msg.body)\n'
+			)
+		self.bot.config.set_local({ 'package-path': [pkgdir] })
+		self.bot.start_instances({ 'echo': { 'of': 'lazystub:Echo', 'lazy': True, 'idle-timeout': 0.2 } })
+
+		# Only a placeholder until the first message
+		self.assertIsInstance(self.bot.objects['echo'], halibot.lazymodule.LazyModule)
+		self.assertNotIn('halibot.packages.lazystub', sys.modules)
+
+		agent = StubAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+
+		# Help the source can answer doesn't load it
+		replies = agent.sync_send_to(halibot.Message(type='help', body=[]), ['echo'], timeout=10)
+		self.assertEqual(replies['echo'][0].body, ['echo', 'when'])
+		replies = agent.sync_send_to(halibot.Message(type='help', body=['echo']), ['echo'], timeout=10)
+		self.assertEqual(replies['echo'][0].body, 'Says it back')
+		self.assertNotIn('halibot.packages.lazystub', sys.modules)
+		agent.received = []
+		agent.send_to(halibot.Message(body='one'), ['echo'])
+		agent.send_to(halibot.Message(body='two'), ['echo'])
+		util.waitOrTimeout(100, lambda: len(agent.received) == 2)
+		self.assertEqual([m.body for m in agent.received], ['one', 'two'])
+		self.assertEqual(type(self.bot.objects['echo']).__name__, 'Echo')
+
+		# Still tracked after a package reload swapped the instance
+		loaded = self.bot.objects['echo']
+		self.bot.reload('lazystub')
+		self.assertIsNot(self.bot.objects['echo'], loaded)
+
+		# Unloaded again once idle
+		util.waitOrTimeout(100, lambda: isinstance(self.bot.objects['echo'], halibot.lazymodule.LazyModule))
+		self.assertIsInstance(self.bot.objects['echo'], halibot.lazymodule.LazyModule)
+
+		# And loaded again when needed, sync replies included
+		replies = agent.sync_send_to(halibot.Message(body='three'), ['echo'], timeout=10)
+		self.assertEqual(replies['echo'][0].body, 'three')
+
+	def test_lazy_subscribe(self):
+		pkgdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, pkgdir)
+		os.mkdir(os.path.join(pkgdir, 'lazycmd'))
+		with open(os.path.join(pkgdir, 'lazycmd', '__init__.py'), 'w') as f:
+			f.write(
+				'import halibot\n'
+				'class Cmd(halibot.CommandModule):\n'
+				'\tHAL_MINIMUM = "0.2.0"\n'
+				'\tdef init(self):\n'
+				'\t\tself.commands = { "cmd": self.cmd }\n'
+				'\tdef cmd(self, args, msg=None):\n'
+				'\t\tself.reply(msg, body="done")\n'
+				'class Raw(Cmd):\n'
+				'\tdef receive(self, msg):\n'
+				'\t\tpass\n'
+			)
+		self.bot.config.set_local({ 'package-path': [pkgdir, os.path.join(halibot.halibot.HALDIR, 'packages')] })
+		self.bot.start_instances({
+			'hello': { 'of': 'hello:Hello', 'lazy': True },
+			'cmd': { 'of': 'lazycmd:Cmd', 'lazy': True },
+			'raw': { 'of': 'lazycmd:Raw', 'lazy': True },
+		})
+
+		# Placeholders follow the subscription or commands of the source
+		route = lambda body: self.bot.dispatch_index.route(halibot.Message(body=body))
+		self.assertEqual(route('just chatting'), ['raw'])
+		self.assertEqual(route('!hello'), ['hello', 'cmd', 'raw'])
+		self.assertEqual(route('!cmd'), ['cmd', 'raw'])
+
+	def test_reload_swap(self):
+		pkgdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, pkgdir)
+		os.mkdir(os.path.join(pkgdir, 'swapstub'))
+		with open(os.path.join(pkgdir, 'swapstub', '__init__.py'), 'w') as f:
+			f.write(
+				'import asyncio, halibot\n'
+				'class Counter(halibot.HalModule):\n'
+				'\tHAL_MINIMUM = "0.2.0"\n'
+				'\tdef init(self):\n'
+				'\t\tself.seen = []\n'
+				'\tasync def receive(self, msg):\n'
+				'\t\tawait asyncio.sleep(0.01)\n'
+				'\t\tself.seen.append(msg.body)\n'
+				'\tdef handover(self, old):\n'
+				'\t\tself.seen = old.seen + self.seen\n'
+			)
+		self.bot.config.set_local({ 'package-path': [pkgdir] })
+		self.bot.start_instances({ 'counter': { 'of': 'swapstub:Counter' } })
+		old = self.bot.objects['counter']
+
+		agent = StubAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+
+		def send():
+			for i in range(50):
+				agent.send_to(halibot.Message(body=i), ['counter'])
+				time.sleep(0.002)
+		sender = threading.Thread(target=send)
+		sender.start()
+		time.sleep(0.03)
+		self.bot.reload('swapstub')
+		sender.join()
+
+		# Every message was handled by one instance or the other, and counted
+		new = self.bot.objects['counter']
+		self.assertIsNot(new, old)
+		self.assertIs(new.inbox.obj, new)
+		util.waitOrTimeout(100, lambda: len(new.seen) == 50)
+		self.assertEqual(sorted(new.seen), list(range(50)))
+		self.assertTrue(0 < len(old.seen) < 50)
+
+		# A replacement failing to init brings the old instance back
+		with open(os.path.join(pkgdir, 'swapstub', '__init__.py'), 'w') as f:
+			f.write(
+				'import halibot\n'
+				'class Counter(halibot.HalModule):\n'
+				'\tHAL_MINIMUM = "0.2.0"\n'
+				'\tdef init(self):\n'
+				'\t\traise ValueError("broken")\n'
+			)
+		self.bot.reload('swapstub')
+		self.assertIs(self.bot.objects['counter'], new)
+		agent.send_to(halibot.Message(body=50), ['counter'])
+		util.waitOrTimeout(100, lambda: new.seen == [50])
+		self.assertEqual(new.seen, [50])
+
+		# Waiting for the swap on the event loop would block it for good
+		async def on_loop():
+			self.bot.reload('swapstub')
+		with self.assertRaises(RuntimeError):
+			asyncio.run_coroutine_threadsafe(on_loop(), self.bot.eventloop).result(5)
+
+	def test_reload_exclusive(self):
+		pkgdir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, pkgdir)
+		os.mkdir(os.path.join(pkgdir, 'portstub'))
+		with open(os.path.join(pkgdir, 'portstub', '__init__.py'), 'w') as f:
+			f.write(
+				'import socket, halibot\n'
+				'class Listener(halibot.HalModule):\n'
+				'\tHAL_MINIMUM = "0.2.0"\n'
+				'\tdef init(self):\n'
+				'\t\tself.sock = socket.socket()\n'
+				'\t\tself.sock.bind(("127.0.0.1", self.config["port"]))\n'
+				'\t\tself.sock.listen()\n'
+				'\tdef shutdown(self):\n'
+				'\t\tself.sock.close()\n'
+			)
+		with socket.socket() as s:
+			s.bind(('127.0.0.1', 0))
+			port = s.getsockname()[1]
+
+		self.bot.config.set_local({ 'package-path': [pkgdir] })
+		self.bot.start_instances({ 'l': { 'of': 'portstub:Listener', 'port': port } })
+		old = self.bot.objects['l']
+
+		# The old instance lets go of the port before the new one takes it
+		self.bot.reload('portstub')
+		new = self.bot.objects['l']
+		self.assertIsNot(new, old)
+		self.assertEqual(new.sock.getsockname()[1], port)
+		self.addCleanup(new.sock.close)
 
 if __name__ == '__main__':
 	unittest.main()
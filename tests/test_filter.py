@@ -41,6 +41,34 @@ class StubBodyFilter(halibot.HalFilter):
 		msg.body += "filtered"
 		return msg
 
+# Records the targets a filter was shown
+class StubTargetFilter(halibot.HalFilter):
+
+	def init(self):
+		self.targets = []
+
+	def filter(self, msg):
+		self.targets.append(msg.target)
+		return msg
+
+# Redirects messages with a 'blank' body nowhere
+class StubBlankFilter(halibot.HalFilter):
+
+	def filter(self, msg):
+		if msg.body == 'blank':
+			msg.target = ''
+		return msg
+
+# Old style filter that does its own hop handling
+class StubHopFilter(halibot.HalFilter):
+
+	def init(self):
+		self.hopped = 0
+
+	def receive(self, msg):
+		self.hopped += 1
+		super().receive(msg)
+
 # --- Classes borrowed from test_core ---
 class StubAgent(halibot.HalAgent):
 	inited = False
@@ -203,5 +231,110 @@ class TestHalFilter(util.HalibotTestCase):
 		self.assertEqual(agent.received[0].body, "foobarfiltered")
 		self.assertTrue(filter.ran)
 
+	def test_fused_pipeline(self):
+		agent = StubAgent(self.bot)
+		mod = StubReplier(self.bot)
+		f1 = StubTargetFilter(self.bot)
+		f2 = StubBodyFilter(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_module', mod)
+		self.bot.add_instance('stub_f1', f1)
+		self.bot.add_instance('stub_f2', f2)
+
+		self.bot.config["filters"] = {
+			"outbound": {
+				"stub_agent": [ "stub_f1" ]
+			},
+			"inbound": {
+				"stub_module": [ "stub_f2" ]
+			}
+		}
+
+		agent.send_to(halibot.Message(body='foo'), ['stub_module/x'])
+		util.waitOrTimeout(100, lambda: len(agent.received) != 0)
+
+		self.assertEqual(agent.received[0].body, "foofilteredbar")
+		self.assertEqual(mod.received[0].target, "stub_module/x")
+		# Filters see the same targets as when hopping through them
+		self.assertEqual(f1.targets, ["stub_f2/stub_module/x"])
+		# ...but no message was queued to them
+		self.assertEqual(f1.inbox.stats['accepted'], 0)
+		self.assertEqual(f2.inbox.stats['accepted'], 0)
+		self.assertEqual(mod.inbox.stats['accepted'], 1)
+
+	def test_malformed_redirect(self):
+		agent = StubAgent(self.bot)
+		mod = StubReplier(self.bot)
+		blank = StubBlankFilter(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_module', mod)
+		self.bot.add_instance('stub_blank', blank)
+		self.bot.config["filters"] = { "inbound": { "stub_module": [ "stub_blank" ] } }
+
+		# The malformed redirect is logged, the rest of the batch still arrives
+		mod.inbox.pause()
+		agent.send_to(halibot.Message(body='blank'), ['stub_module'])
+		agent.send_to(halibot.Message(body='foo'), ['stub_module'])
+		with self.assertLogs(blank.log, 'ERROR'):
+			mod.inbox.resume()
+			util.waitOrTimeout(100, lambda: len(agent.received) != 0)
+		self.assertEqual(agent.received[0].body, 'foobar')
+		self.assertEqual(mod.inbox._inflight, 0)
+
+	def test_hop_filter(self):
+		agent = StubAgent(self.bot)
+		mod = StubReplier(self.bot)
+		hop = StubHopFilter(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_module', mod)
+		self.bot.add_instance('stub_hop', hop)
+
+		self.bot.config["filters"] = {
+			"inbound": {
+				"stub_module": [ "stub_hop" ]
+			}
+		}
+
+		agent.send_to(halibot.Message(body='foo'), ['stub_module'])
+		util.waitOrTimeout(100, lambda: len(agent.received) != 0)
+
+		self.assertEqual(agent.received[0].body, "foobar")
+		self.assertEqual(hop.hopped, 1)
+
+	def test_route_table(self):
+		agent = StubAgent(self.bot)
+		mod = StubReplier(self.bot)
+		filter = StubFilter(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		self.bot.add_instance('stub_module', mod)
+		self.bot.add_instance('stub_filter', filter)
+
+		self.assertEqual(agent.apply_filter('stub_module/foo'), 'stub_module/foo')
+
+		# Replacing the filters key invalidates the compiled routes
+		self.bot.config["filters"] = {
+			"inbound": {
+				"stub_module": [ "stub_filter" ]
+			},
+			"outbound": {
+				"stub_agent": [ "stub_filter" ]
+			}
+		}
+		self.assertEqual(agent.apply_filter('stub_module/foo'), 'stub_filter/stub_filter/stub_module/foo')
+		self.assertEqual(mod.apply_filter('stub_agent'), 'stub_agent')
+
+		# Routes are compiled per instance, not per user
+		self.assertEqual(agent.apply_filter('stub_module/bar'), 'stub_filter/stub_filter/stub_module/bar')
+		self.assertEqual(set(self.bot.routes._tables.routes), { ('stub_agent', 'stub_module'), ('stub_module', 'stub_agent') })
+
+		# A route compiled while the table was invalidated isn't kept
+		tables = self.bot.routes._tables
+		self.bot.routes.invalidate()
+		tables.routes[('stub_agent', 'stale')] = tables.routes[('stub_agent', 'stub_module')]
+		self.assertEqual(agent.apply_filter('stale'), 'stub_filter/stale')
+
+		del self.bot.config["filters"]
+		self.assertEqual(agent.apply_filter('stub_module/foo'), 'stub_module/foo')
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,103 @@
+import util
+import halibot
+import unittest
+import asyncio
+from packages.core import Help
+
+class StubModule(halibot.HalModule):
+
+	topics = {
+		'topic1': 'Help text one',
+		'topic2': lambda: 'Help text two',
+	}
+
+class StubAgent(halibot.HalAgent):
+
+	def init(self):
+		self.received = []
+
+	def receive(self, msg):
+		self.received.append(msg)
+
+class TestHelp(util.HalibotTestCase):
+
+	def setUp(self):
+		super().setUp()
+		self.agent = StubAgent(self.bot)
+		self.bot.add_instance('stub_agent', self.agent)
+		self.bot.add_instance('stub_module', StubModule(self.bot))
+		self.bot.add_instance('help', Help(self.bot))
+
+	def ask(self, body, dest='help'):
+		self.agent.received = []
+		self.agent.send_to(halibot.Message(body=body), [dest])
+		util.waitOrTimeout(100, lambda: len(self.agent.received) != 0)
+		self.assertEqual(len(self.agent.received), 1)
+		return self.agent.received[0].body
+
+	def test_general_help(self):
+		text = self.ask('!help')
+		self.assertIn('Available topics:', text)
+		self.assertIn('topic1, topic2', text)
+
+	def test_topic_index(self):
+		class CustomHelp(halibot.HalModule):
+			def receive_help(self, msg):
+				if msg.body == []:
+					self.reply(msg, body=['custom'])
+
+		self.bot.add_instance('stub_custom', CustomHelp(self.bot))
+		text = self.ask('!help')
+		self.assertIn('topic1, topic2, custom', text)
+
+		# Answered from the index, without asking the modules again
+		accepted = self.bot.objects['stub_custom'].inbox.stats['accepted']
+		self.ask('!help')
+		self.assertEqual(self.bot.objects['stub_custom'].inbox.stats['accepted'], accepted)
+		self.assertEqual(self.bot.objects['stub_module'].inbox.stats['accepted'], 0)
+
+		# Loading another module invalidates it
+		class OtherModule(halibot.HalModule):
+			topics = { 'topic3': 'Help text three' }
+		self.bot.add_instance('stub_other', OtherModule(self.bot))
+		self.assertIn('topic1, topic2, custom, topic3', self.ask('!help'))
+
+	def test_topic_help(self):
+		self.assertEqual(self.ask('!help topic1'), 'Help text one')
+		self.assertEqual(self.ask('!help topic2'), 'Help text two')
+
+		# Modules without topics aren't asked
+		class NoTopics(halibot.HalModule):
+			topics = {}
+		self.bot.add_instance('stub_none', NoTopics(self.bot))
+		self.assertEqual(self.ask('!help topic1'), 'Help text one')
+		self.assertEqual(self.bot.objects['stub_none'].inbox.stats['accepted'], 0)
+
+	def test_deadline(self):
+		class SlowHelp(halibot.HalModule):
+			async def receive_help(self, msg):
+				await asyncio.sleep(0.5)
+				self.reply(msg, body='Too late')
+
+		self.bot.add_instance('stub_slow', SlowHelp(self.bot))
+		help = Help(self.bot, { 'timeout': 0.1, 'miss-warn': 2 })
+		self.bot.add_instance('help_fast', help)
+
+		# The first answer wins, without waiting on the slow module
+		self.assertEqual(self.ask('!help topic1', 'help_fast'), 'Help text one')
+		self.assertEqual(help.misses, {})
+
+		# Nobody else answers, so the slow module misses the deadline
+		with self.assertLogs(help.log, 'WARNING'):
+			for i in range(2):
+				self.agent.received = []
+				self.agent.send_to(halibot.Message(body='!help nothing'), ['help_fast'])
+				util.waitOrTimeout(100, lambda: help.misses.get('stub_slow') == i + 1)
+		self.assertEqual(help.misses, { 'stub_slow': 2 })
+		self.assertEqual(self.agent.received, [])
+
+		# Let the late handlers finish before the loop shuts down
+		util.waitOrTimeout(100, lambda: self.bot.objects['stub_slow'].inbox._inflight == 0)
+
+if __name__ == '__main__':
+	unittest.main()
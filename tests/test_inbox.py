@@ -0,0 +1,141 @@
+import util
+import halibot
+import unittest
+import threading
+import asyncio
+
+class StubModule(halibot.HalModule):
+
+	def init(self):
+		self.received = []
+		self.gate = None
+
+	def receive(self, msg):
+		if self.gate:
+			self.gate.wait()
+		self.received.append(msg.body)
+
+# Floods the target from the loop thread, so nothing drains in between
+class FloodModule(halibot.HalModule):
+
+	def receive(self, msg):
+		for i in range(5):
+			self.send_to(halibot.Message(body=i), ['stub_target'])
+
+class TestInbox(util.HalibotTestCase):
+
+	def flood(self, policy):
+		flood = FloodModule(self.bot)
+		target = StubModule(self.bot, conf={ 'inbox-size': 2, 'inbox-policy': policy })
+		self.bot.add_instance('stub_flood', flood)
+		self.bot.add_instance('stub_target', target)
+
+		agent = halibot.HalAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+		agent.send_to(halibot.Message(body='go'), ['stub_flood'])
+		util.waitOrTimeout(100, lambda: target.inbox.stats['accepted'] >= 2 and len(target.inbox) == 0 and len(target.received) >= 2)
+		return target
+
+	def test_drop_newest(self):
+		target = self.flood('drop-newest')
+		self.assertEqual(target.received, [0, 1])
+		self.assertEqual(target.inbox.stats['dropped-newest'], 3)
+
+	def test_drop_oldest(self):
+		target = self.flood('drop-oldest')
+		self.assertEqual(target.received, [3, 4])
+		self.assertEqual(target.inbox.stats['dropped-oldest'], 3)
+
+	def test_dead_letter(self):
+		target = self.flood('dead-letter')
+		self.assertEqual(target.received, [0, 1])
+		self.assertEqual(target.inbox.stats['dead-lettered'], 3)
+		self.assertEqual([m.body for n, m in self.bot.dead_letters], [2, 3, 4])
+		self.assertEqual(self.bot.dead_letters[0][0], 'stub_target')
+
+	def test_block_on_loop(self):
+		target = self.flood('block')
+		util.waitOrTimeout(100, lambda: len(target.received) == 5)
+		self.assertEqual(target.received, [0, 1, 2, 3, 4])
+		self.assertEqual(target.inbox.stats['overflowed'], 3)
+
+	def test_block_thread(self):
+		target = StubModule(self.bot, conf={ 'inbox-size': 2 })
+		agent = halibot.HalAgent(self.bot)
+		self.bot.add_instance('stub_target', target)
+		self.bot.add_instance('stub_agent', agent)
+
+		# Wedge the loop inside the first delivery
+		target.gate = threading.Event()
+		agent.send_to(halibot.Message(body=0), ['stub_target'])
+		util.waitOrTimeout(100, lambda: len(target.inbox) == 0)
+
+		def sender():
+			for i in range(1, 4):
+				agent.send_to(halibot.Message(body=i), ['stub_target'])
+
+		thread = threading.Thread(target=sender)
+		thread.start()
+		util.waitOrTimeout(100, lambda: target.inbox.stats['blocked'] == 1)
+		self.assertEqual(target.inbox.stats['blocked'], 1)
+		self.assertTrue(thread.is_alive())
+
+		target.gate.set()
+		thread.join()
+		util.waitOrTimeout(100, lambda: len(target.received) == 4)
+		self.assertEqual(target.received, [0, 1, 2, 3])
+
+	def test_inflight_bound(self):
+		class AsyncModule(halibot.HalModule):
+			def init(self):
+				self.received = []
+				self.release = asyncio.Event()
+
+			async def receive(self, msg):
+				self.received.append(msg.body)
+				await self.release.wait()
+
+		target = AsyncModule(self.bot, conf={ 'inbox-size': 2, 'inbox-policy': 'drop-newest' })
+		agent = halibot.HalAgent(self.bot)
+		self.bot.add_instance('stub_target', target)
+		self.bot.add_instance('stub_agent', agent)
+
+		# Both slots are taken by handlers that have not finished yet
+		for i in range(2):
+			agent.send_to(halibot.Message(body=i), ['stub_target'])
+		util.waitOrTimeout(100, lambda: len(target.received) == 2)
+		agent.send_to(halibot.Message(body=2), ['stub_target'])
+		self.assertEqual(target.inbox.stats['dropped-newest'], 1)
+
+		self.bot.eventloop.call_soon_threadsafe(target.release.set)
+		util.waitOrTimeout(100, lambda: target.inbox._inflight == 0)
+		agent.send_to(halibot.Message(body=3), ['stub_target'])
+		util.waitOrTimeout(100, lambda: len(target.received) == 3)
+		self.assertEqual(target.received, [0, 1, 3])
+
+	def test_pause(self):
+		target = StubModule(self.bot)
+		self.bot.add_instance('stub_target', target)
+		agent = halibot.HalAgent(self.bot)
+		self.bot.add_instance('stub_agent', agent)
+
+		target.inbox.pause()
+		for i in range(3):
+			agent.send_to(halibot.Message(body=i), ['stub_target'])
+		util.waitOrTimeout(5, lambda: len(target.received) != 0)
+		self.assertEqual(target.received, [])
+		self.assertEqual(len(target.inbox), 3)
+
+		# Nothing running, so already idle
+		asyncio.run_coroutine_threadsafe(target.inbox.wait_idle(), self.bot.eventloop).result(5)
+
+		target.inbox.resume()
+		util.waitOrTimeout(100, lambda: len(target.received) == 3)
+		self.assertEqual(target.received, [0, 1, 2])
+
+	def test_bad_policy(self):
+		with self.assertRaises(ValueError):
+			StubModule(self.bot, conf={ 'inbox-policy': 'nope' })
+
+if __name__ == '__main__':
+	unittest.main()
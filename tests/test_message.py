@@ -1,6 +1,7 @@
 import util
 import halibot
 import unittest
+import copy
 
 testMessage = halibot.Message(body="foo", type="bar", author="Foo Barrington", identity="yes", origin="Assyria", misc="[\"foo\", \"bar\"]", target="bees?")
 
@@ -26,5 +27,50 @@ class TestMessage(util.HalibotTestCase):
 		self.assertEqual("[\"foo\", \"bar\"]", m.misc)
 		self.assertEqual("bees?", m.target)
 
+	def testLazyFields(self):
+		m = halibot.Message(body="foo")
+		self.assertIsNone(m._uuid)
+		self.assertIsNone(m._misc)
+
+		# Generated once, then stable
+		self.assertEqual(m.uuid, m.uuid)
+		m.misc.foo = "bar"
+		self.assertEqual(m.misc["foo"], "bar")
+
+		with self.assertRaises(AttributeError):
+			m.unknown = True
+
+	def testCopy(self):
+		m = halibot.Message(body="foo", origin="Assyria")
+		m.sync = True
+		c = copy.copy(m)
+
+		# Copies of sync messages share the uuid replies are matched by
+		self.assertEqual(m.uuid, c.uuid)
+		self.assertEqual("foo", c.body)
+		self.assertEqual("Assyria", c.origin)
+		self.assertTrue(c.sync)
+
+	def testCopyOnWrite(self):
+		m = halibot.Message(body="foo")
+		m.misc.foo = "bar"
+		c1 = copy.copy(m)
+		c2 = m.derive(target="baz")
+
+		self.assertIs(m._misc, c1._misc)
+		self.assertEqual("baz", c2.target)
+		self.assertEqual("", m.target)
+
+		# Each copy owns its misc once it is touched
+		c1.misc.foo = "c1"
+		c2.misc.qux = "c2"
+		self.assertEqual(m.misc, { "foo": "bar" })
+		self.assertEqual(c1.misc, { "foo": "c1" })
+		self.assertEqual(c2.misc, { "foo": "bar", "qux": "c2" })
+
+		# Nothing to share if misc was never allocated
+		n = halibot.Message(body="foo")
+		self.assertFalse(copy.copy(n)._shared)
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,118 @@
+import util
+import halibot
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+
+class TestPackageIndex(util.HalibotTestCase):
+
+	def setUp(self):
+		super().setUp()
+		self.path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.path)
+		self.bot.config.set_local({ 'package-path': [self.path] })
+		self.addCleanup(self.unimport)
+
+		self.write('idxstub/__init__.py',
+			'from .mods import Old, New as Renamed\n'
+			'from .computed import Computed\n'
+			'import halibot\n'
+			'class Agent(halibot.HalAgent):\n'
+			'\tHAL_MINIMUM = "0.1"\n'
+			'Default = Renamed\n'
+		)
+		self.write('idxstub/mods.py',
+			'from halibot import HalModule\n'
+			'class Base(HalModule):\n'
+			'\tVERSION = "1.2.3"\n'
+			'\tHAL_MINIMUM = "0.1"\n'
+			'\ttopics = { "base": "Base help", "later": lambda: "Later" }\n'
+			'class New(Base):\n'
+			'\tpass\n'
+			'class Old(Base):\n'
+			'\tHAL_MAXIMUM = "0.1"\n'
+			'\tsubscribe = { "types": ["simple"] }\n'
+		)
+		self.write('idxstub/computed.py',
+			'import halibot\n'
+			'class Computed(halibot.HalFilter):\n'
+			'\tHAL_MINIMUM = ".".join(["0", "1"])\n'
+		)
+		self.write('notapackage.txt', '')
+
+	def unimport(self):
+		for m in [m for m in sys.modules if m.startswith('halibot.packages.idxstub')]:
+			del sys.modules[m]
+
+	def write(self, name, text):
+		path = os.path.join(self.path, name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, 'w') as f:
+			f.write(text)
+
+	def test_index(self):
+		idx = self.bot.package_index
+		self.assertEqual(idx.names(), ['idxstub'])
+
+		info = idx.get('idxstub')
+		self.assertEqual(set(info.classes), { 'Old', 'Renamed', 'Computed', 'Agent', 'Default' })
+
+		new = idx.find('idxstub', 'Default')
+		self.assertEqual(new.name, 'New')
+		self.assertEqual(new.kind, 'module')
+		self.assertEqual(new.version, '1.2.3')
+		self.assertTrue(new.static)
+		self.assertEqual(new.topics, { 'base': 'Base help', 'later': None })
+		self.assertIsNone(idx.find('idxstub', 'Agent').topics)
+		self.assertEqual(idx.find('idxstub', 'Agent').kind, 'agent')
+		self.assertEqual(idx.find('idxstub', 'Old').attrs['HAL_MAXIMUM'], '0.1')
+		self.assertEqual(idx.find('idxstub', 'Old').subscribe, { 'types': ['simple'] })
+		self.assertIsNone(new.subscribe)
+
+		computed = idx.find('idxstub', 'Computed')
+		self.assertEqual(computed.kind, 'filter')
+		self.assertFalse(computed.static)
+
+		# Parsed again only once the source changes
+		self.assertIs(idx.get('idxstub'), info)
+		path = os.path.join(self.path, 'idxstub', 'mods.py')
+		with open(path, 'a') as f:
+			f.write('class Newer(Base):\n\tpass\n')
+		st = os.stat(path)
+		os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+		self.assertIsNot(idx.get('idxstub'), info)
+
+	def test_load_rejects_before_import(self):
+		self.assertIsNone(self.bot.load_object('idxstub:Old'))
+		self.assertNotIn('halibot.packages.idxstub', sys.modules)
+
+		self.assertIsNotNone(self.bot.load_object('idxstub:Default'))
+		self.assertIn('halibot.packages.idxstub', sys.modules)
+
+	def test_load_warns_once(self):
+		self.write('idxstub_nomin.py',
+			'import halibot\n'
+			'class NoMin(halibot.HalModule):\n'
+			'\tpass\n'
+		)
+		self.assertTrue(self.bot.package_index.find('idxstub_nomin', 'NoMin').static)
+		with self.assertLogs(self.bot.log, 'WARNING') as logs:
+			self.assertIsNotNone(self.bot.load_object('idxstub_nomin:NoMin'))
+		self.assertEqual(len([l for l in logs.output if 'minimum version' in l]), 1)
+
+	def test_load_checks_after_import(self):
+		# Looks fine in the class body, but is changed once imported
+		self.write('idxstub_patched.py',
+			'import halibot\n'
+			'class Patched(halibot.HalModule):\n'
+			'\tHAL_MINIMUM = "0.1"\n'
+			'Patched.HAL_MAXIMUM = "0.1"\n'
+		)
+		self.assertTrue(self.bot.package_index.find('idxstub_patched', 'Patched').static)
+		with self.assertLogs(self.bot.log, 'ERROR'):
+			self.assertIsNone(self.bot.load_object('idxstub_patched:Patched'))
+
+if __name__ == '__main__':
+	unittest.main()
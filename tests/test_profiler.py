@@ -0,0 +1,78 @@
+import util
+import halibot
+import unittest
+import io
+import json
+import os
+import sys
+import shutil
+import tempfile
+
+class TestStartupProfile(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.path)
+		os.mkdir(os.path.join(self.path, 'profstub'))
+		with open(os.path.join(self.path, 'profstub', '__init__.py'), 'w') as f:
+			f.write(
+				'from . import slow\n'
+				'import halibot\n'
+				'class Stub(halibot.HalModule):\n'
+				'\tHAL_MINIMUM = "0.1"\n'
+			)
+		with open(os.path.join(self.path, 'profstub', 'slow.py'), 'w') as f:
+			f.write('import time\ntime.sleep(0.05)\n')
+
+	def tearDown(self):
+		for m in [m for m in sys.modules if m.startswith('halibot.packages.profstub')]:
+			del sys.modules[m]
+
+	def test_profile(self):
+		report = os.path.join(self.path, 'report.json')
+		profile = halibot.StartupProfile(path=report)
+		bot = halibot.Halibot(use_config=False, profile=profile)
+		self.addCleanup(bot.eventloop.close)
+		bot.config.set_local({ 'package-path': [self.path] })
+		bot.start_instances({ 'stub': { 'of': 'profstub:Stub' } })
+
+		out = io.StringIO()
+		profile.finish(out=out)
+		self.assertNotIn(profile._tracer, sys.meta_path)
+		self.assertIn('profstub.slow', out.getvalue())
+
+		with open(report) as f:
+			report = json.load(f)
+		phases = { (p['kind'], p['name']): p for p in report['phases'] }
+		self.assertIn(('construct', 'stub'), phases)
+		self.assertIn(('init', 'stub'), phases)
+		self.assertEqual(phases[('import', 'profstub')]['parent'], 'stub')
+
+		# The slow submodule shows up as the slowest import, nested in its package
+		slow = report['imports'][0]
+		self.assertEqual(slow['name'], 'halibot.packages.profstub.slow')
+		self.assertEqual(slow['parent'], 'halibot.packages.profstub')
+		self.assertGreaterEqual(slow['self'], 0.05)
+
+	def test_config_read_once(self):
+		with open(os.path.join(self.path, 'config.json'), 'w') as f:
+			json.dump({ 'package-path': [self.path], 'config-reload-interval': 0 }, f)
+		profile = halibot.StartupProfile()
+		bot = halibot.Halibot(workdir=self.path, profile=profile)
+
+		# As 'halibot run' does, to read the log settings before starting
+		bot._load_config()
+		bot.start(block=False)
+		bot.shutdown()
+		bot.eventloop.close()
+
+		self.assertEqual([t.kind for t in profile.timings].count('config'), 1)
+
+	def test_disabled(self):
+		profile = halibot.StartupProfile(enabled=False)
+		with profile.phase('import', 'nothing'):
+			pass
+		self.assertEqual(profile.timings, [])
+
+if __name__ == '__main__':
+	unittest.main()
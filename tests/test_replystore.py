@@ -0,0 +1,41 @@
+import unittest
+from halibot.replystore import ReplyStore
+
+class TestReplyStore(unittest.TestCase):
+
+	def test_add_pop(self):
+		s = ReplyStore()
+		s.add('a', 1)
+		s.add('a', 2)
+		s.add('b', 3)
+
+		self.assertTrue('a' in s)
+		self.assertEqual(s.pop('a'), [1, 2])
+		self.assertFalse('a' in s)
+		self.assertEqual(s.pop('a'), None)
+		self.assertEqual(len(s), 1)
+
+	def test_expire(self):
+		s = ReplyStore(ttl=10)
+		s.add('a', 1)
+		s.add('b', 2)
+		s.add('b', 3)
+
+		s.expire(now=s._entries['b'][0])
+		self.assertEqual(len(s), 0)
+		self.assertEqual(s.stats['expired'], 2)
+		self.assertEqual(s.stats['orphaned'], 3)
+
+	def test_maxsize(self):
+		s = ReplyStore(maxsize=2)
+		s.add('a', 1)
+		s.add('b', 2)
+		s.add('c', 3)
+
+		self.assertFalse('a' in s)
+		self.assertEqual(s.pop('c'), [3])
+		self.assertEqual(s.stats['evicted'], 1)
+		self.assertEqual(s.stats['orphaned'], 1)
+
+if __name__ == '__main__':
+	unittest.main()